@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import json
+import operator
+import numpy as np
+import pandas as pd
+
+# "GT": [limit] matches a bundle whose property is greater than limit, and so on
+OPERATORS = {"EQ": operator.eq,
+             "NE": operator.ne,
+             "GT": operator.gt,
+             "GE": operator.ge,
+             "LT": operator.lt,
+             "LE": operator.le}
+
+def compare(op, value, limit):
+    # a missing or non comparable property (None, an address against a number) does not match
+    try:
+        return bool(OPERATORS[op](value, limit))
+    except TypeError:
+        return False
+
+def parse_rules(rules):
+    if isinstance(rules, str):
+        rules = json.loads(rules)
+    # unknown operators are ignored, as they always were
+    return [(r, rules[r][0], rules[r][1]) for r in rules if rules[r][0] in OPERATORS]
+
+def compile_rules(rules):
+    # properties missing from the bundle count as 0
+    conditions = [(r, OPERATORS[op], limit) for r, op, limit in parse_rules(rules)]
+
+    def predicate(bundle):
+        for r, f, limit in conditions:
+            try:
+                if not f(bundle[r] if r in bundle else 0, limit):
+                    return False
+            except TypeError:
+                return False
+        return True
+    return predicate
+
+def compile_attack_classes(attack_classes):
+    # t_attack_classes rows get their parsed rules, conditions and predicate, once
+    for c in attack_classes:
+        if isinstance(c["rules"], str):
+            c["rules"] = json.loads(c["rules"])
+        c["conditions"] = parse_rules(c["rules"])
+        c["predicate"] = compile_rules(c["rules"])
+    return attack_classes
+
+def feature_frame(bundles, properties):
+    # one row per bundle, one column per property used by the rules
+    return pd.DataFrame([[bundle[r] if r in bundle else 0 for r in properties] for bundle in bundles],
+                        columns=properties, dtype=object)
+
+def _column_mask(column, op, limit):
+    # the same answers as compare, element by element: values of a type not comparable with the limit do not match
+    if op in ["EQ", "NE"]:
+        if limit is None:
+            mask = column.isin([None]).values
+        elif isinstance(limit, (list, dict)):
+            # properties are scalars, never equal to a list or an object
+            mask = np.zeros(len(column), dtype=bool)
+        else:
+            mask = column.eq(limit).values.astype(bool)
+        return mask if op == "EQ" else ~mask
+    strings = column.map(type).eq(str).values
+    if isinstance(limit, (int, float)):
+        numbers = pd.to_numeric(column.where(~strings), errors="coerce").values.astype(float)
+        with np.errstate(invalid="ignore"):
+            return OPERATORS[op](numbers, limit)
+    mask = np.zeros(len(column), dtype=bool)
+    if isinstance(limit, str) and strings.any():
+        mask[strings] = OPERATORS[op](column[strings].astype(str), limit).values
+    return mask
+
+def classify_bundles(bundles, attack_classes):
+    # bundles x attack classes boolean matrix, rows follow the order of bundles, columns are attackClassIds
+    bundles = list(bundles)
+    properties = sorted(set(r for c in attack_classes for r, op, limit in c["conditions"]))
+    features = feature_frame(bundles, properties)
+    columns = {}
+    masks = {}
+    for c in attack_classes:
+        match = np.ones(len(bundles), dtype=bool)
+        for r, op, limit in c["conditions"]:
+            key = (r, op, json.dumps(limit))
+            if not key in masks:
+                masks[key] = _column_mask(features[r], op, limit)
+            match &= masks[key]
+        columns[c["attackClassId"]] = match
+    return pd.DataFrame(columns, columns=[c["attackClassId"] for c in attack_classes], dtype=bool)
@@ -0,0 +1,224 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import sys
+import random
+import timeit
+from hexbytes import HexBytes
+
+from price_monitor import group_block_transactions, transaction_prefix_counts, prescreen_groups, collect_bundle_transactions, make_block_bundles
+from bundle import Bundle, TokenTable
+
+TRANSFER_TOPIC = "0xddf252ad1be2c89b69c2b068fc378daa952ba7f163c4a11628f55a4df523b3ef"
+
+def _address(i):
+    return "0x%040x" % i
+
+def synthetic_block(block_number, n_transactions, n_attackers=20, attacker_share=0.3, seed=0):
+    # busy block: a share of transactions comes from a few repeated (from, to) pairs, the rest are unique senders
+    rng = random.Random(seed)
+    attackers = [(_address(0x1000 + i), _address(0x2000 + i)) for i in range(n_attackers)]
+    transactions = []
+    receipts = {}
+    for ti in range(n_transactions):
+        if rng.random() < attacker_share:
+            tx_from, tx_to = rng.choice(attackers)
+        else:
+            tx_from, tx_to = _address(0x10000 + ti), _address(0x20000 + rng.randint(0, n_transactions))
+        tx_hash = HexBytes(rng.randbytes(32))
+        transactions.append({"hash": tx_hash, "from": tx_from, "to": tx_to, "transactionIndex": ti,
+                             "gasPrice": 30 * 10**9, "value": 0})
+        logs = [{"address": _address(0x30000 + rng.randint(0, 50)), "blockNumber": block_number,
+                 "transactionHash": tx_hash.hex(), "data": "0x" + "%064x" % rng.randint(1, 10**20),
+                 "topics": [TRANSFER_TOPIC, "0x" + "00" * 32, "0x" + "00" * 32]}
+                for _ in range(rng.randint(0, 3))]
+        receipts[tx_hash.hex()] = {"status": 1, "gasUsed": 100000, "effectiveGasPrice": 30 * 10**9, "logs": logs}
+    block = {"number": block_number, "baseFeePerGas": 20 * 10**9, "transactions": transactions}
+    return block, receipts
+
+def legacy_detector(block_number, block, receipts, run_context):
+    # the range-scanning detector process_block used before, kept for comparison
+    base_fee_per_gas = block["baseFeePerGas"]
+    _from_to_hashes = {}
+    for transaction in block["transactions"]:
+        if "to" in transaction and not transaction["to"] is None:
+            if transaction["to"] in run_context["multisender_attackers"]:
+                transaction_from = None
+            else:
+                transaction_from = transaction["from"]
+            if (transaction_from, transaction["to"]) in run_context["attaker_status"] and run_context["attaker_status"][(transaction_from, transaction["to"])] == -1:
+                continue
+            if (None, transaction["to"]) in run_context["attaker_status"] and run_context["attaker_status"][(None, transaction["to"])] == -1:
+                continue
+            if not (transaction_from, transaction["to"]) in _from_to_hashes:
+                _from_to_hashes[(transaction_from, transaction["to"])] = {"count": 1, "tx_counter": 0,
+                                                                          "min_index": transaction["transactionIndex"],
+                                                                          "max_index": transaction["transactionIndex"]}
+            else:
+                _from_to_hashes[(transaction_from, transaction["to"])]["count"] += 1
+                _from_to_hashes[(transaction_from, transaction["to"])]["min_index"] = min(_from_to_hashes[(transaction_from, transaction["to"])]["min_index"],
+                                                                                          transaction["transactionIndex"])
+                _from_to_hashes[(transaction_from, transaction["to"])]["max_index"] = max(_from_to_hashes[(transaction_from, transaction["to"])]["max_index"],
+                                                                                          transaction["transactionIndex"])
+    from_to_hashes = {f: _from_to_hashes[f] for f in _from_to_hashes if _from_to_hashes[f]["count"] > 1}
+
+    block_transactions = []
+    block_events = []
+    block_attakers = {}
+    for from_to in from_to_hashes:
+        from_to_events = []
+        block_attakers[from_to] = {"status": 1}
+        min_index = None
+        max_index = None
+        for ti in range(from_to_hashes[from_to]["min_index"], from_to_hashes[from_to]["max_index"]+1):
+            transaction = block["transactions"][ti]
+            if (transaction["from"] != from_to[0] and not from_to[0] is None) or transaction["to"] != from_to[1]:
+                continue
+            transaction_hash = transaction["hash"].hex()
+            if not transaction_hash in block_transactions:
+                receipt = receipts[transaction_hash]
+                if receipt["status"] != 1:
+                    continue
+                for e in receipt["logs"]:
+                    from_to_events.append(dict(e))
+                if max_index is None or max_index < ti:
+                    max_index = ti
+                if min_index is None or min_index > ti:
+                    min_index = ti
+                block_transactions.append({"hash": transaction_hash, "blockNumber": block_number,
+                                           "fromTx": transaction["from"], "toTx": transaction["to"],
+                                           "transactionIndex": transaction["transactionIndex"],
+                                           "gasBurnt": base_fee_per_gas * receipt["gasUsed"],
+                                           "gasOverpay": (receipt["effectiveGasPrice"] - base_fee_per_gas) * receipt["gasUsed"]})
+        from_to_hashes[from_to]["min_index"] = min_index
+        from_to_hashes[from_to]["max_index"] = max_index
+        if len(from_to_events) == 0:
+            block_attakers[from_to] = {"status": 0}
+        else:
+            block_events.extend(from_to_events)
+
+    for from_to in from_to_hashes:
+        if block_attakers[from_to]["status"] == 0:
+            continue
+        for transaction in block["transactions"][from_to_hashes[from_to]["min_index"]+1:from_to_hashes[from_to]["max_index"]+1]:
+            if (transaction["from"] == from_to[0] or from_to[0] is None) and transaction["to"] == from_to[1]:
+                continue
+            if "to" in transaction:
+                from_to_hashes[from_to]["tx_counter"] += 1
+
+    hashes_to_delete = []
+    for from_to in from_to_hashes:
+        if not from_to_hashes[from_to]["tx_counter"]:
+            for t in block_transactions:
+                if (t["fromTx"] == from_to[0] or from_to[0] is None) and t["toTx"] == from_to[1]:
+                    hashes_to_delete.append(t["hash"])
+    block_transactions = [t for t in block_transactions if not t["hash"] in hashes_to_delete]
+    block_events = [e for e in block_events if not e["transactionHash"] in hashes_to_delete]
+    return block_transactions, block_events, {f: from_to_hashes[f]["tx_counter"] for f in from_to_hashes if from_to_hashes[f]["tx_counter"] > 0}
+
+def linear_detector(block_number, block, receipts, run_context):
+    groups = group_block_transactions(block["transactions"], run_context)
+    prefix_counts = transaction_prefix_counts(block["transactions"])
+    groups = prescreen_groups(groups, prefix_counts)
+    block_transactions, block_events, from_to_hashes = collect_bundle_transactions(block_number, block, groups, receipts, prefix_counts)
+    make_block_bundles(block_number, block_transactions, from_to_hashes)
+    return block_transactions, block_events, {f: from_to_hashes[f]["tx_counter"] for f in from_to_hashes}
+
+def bench_detector(sizes=(100, 300, 600), repeat=20):
+    run_context = {"multisender_attackers": [], "attaker_status": {}}
+    for n in sizes:
+        block, receipts = synthetic_block(19000000, n, seed=n)
+        legacy = legacy_detector(19000000, block, receipts, run_context)
+        linear = linear_detector(19000000, block, receipts, run_context)
+        assert [t["hash"] for t in legacy[0]] == [t["hash"] for t in linear[0]]
+        assert len(legacy[1]) == len(linear[1]) and legacy[2] == linear[2]
+        t_legacy = min(timeit.repeat(lambda: legacy_detector(19000000, block, receipts, run_context), number=1, repeat=repeat))
+        t_linear = min(timeit.repeat(lambda: linear_detector(19000000, block, receipts, run_context), number=1, repeat=repeat))
+        print("detector, {} transactions, {} bundles: legacy {:.2f} ms, linear {:.2f} ms, x{:.1f}".format(
+            n, len(linear[2]), t_legacy * 1000, t_linear * 1000, t_legacy / t_linear))
+
+def synthetic_swaps(n_bundles, n_swaps, n_pools=50, seed=0):
+    # v2 swap amounts of a block spread over its bundles, a few tokens have 6 or 8 decimals,
+    # the decimals are returned with the swaps and the registry of price_monitor is left alone
+    rng = random.Random(seed)
+    tokens = [_address(0x50000 + i) for i in range(n_pools // 2)]
+    decimals = {token: 1e6 for token in tokens[:3]}
+    decimals[tokens[3]] = 1e8
+    pools = [tuple(sorted(rng.sample(tokens, 2))) for _ in range(n_pools)]
+    swaps = []
+    for _ in range(n_swaps):
+        token0, token1 = rng.choice(pools)
+        amount_in, amount_out = rng.randint(1, 10**24), rng.randint(1, 10**24)
+        if rng.random() < 0.5:
+            swaps.append((rng.randrange(n_bundles), token0, token1, amount_in, 0, 0, amount_out))
+        else:
+            swaps.append((rng.randrange(n_bundles), token0, token1, 0, amount_in, amount_out, 0))
+    return swaps, decimals
+
+def decimals_lookup(decimals):
+    return lambda token: decimals.get(token, 1e18)
+
+def legacy_add_tokens(bundle, *tokens):
+    for token in tokens:
+        if not token in bundle["saldo"]:
+            bundle["saldo"][token] = 0
+            bundle["capitalRequirements"][token] = 0
+
+def legacy_change_capital(bundle, *tokens):
+    for token in tokens:
+        if bundle["saldo"][token] < -bundle["capitalRequirements"][token]:
+            bundle["capitalRequirements"][token] = -bundle["saldo"][token]
+
+def legacy_accounting(swaps, coin_decimals):
+    # float balances divided by the decimals on every update, the bundle started by make_properties,
+    # as the v2 swap branch of process_bundles did before
+    bundles = {}
+    for b, token0, token1, amount0In, amount1In, amount0Out, amount1Out in swaps:
+        if not b in bundles:
+            bundles[b] = {"saldo": {token0: 0, token1: 0, "eth": 0}, "capitalRequirements": {token0: 0, token1: 0, "eth": 0},
+                          "rates": {}, "directBribe": 0, "gasBurnt": 0, "gasOverpay": 0, "txs": set(),
+                          "a_mintBurnV3": 0, "a_mintBurnNFT": 0, "a_uniswapV2": 0, "a_uniswapV3": 0, "a_pancakeV3": 0}
+        bundle = bundles[b]
+        bundle["a_uniswapV2"] += 1
+        legacy_add_tokens(bundle, token0, token1)
+        bundle["saldo"][token0] -= amount0In/coin_decimals(token0)
+        bundle["saldo"][token0] += amount0Out/coin_decimals(token0)
+        bundle["saldo"][token1] -= amount1In/coin_decimals(token1)
+        bundle["saldo"][token1] += amount1Out/coin_decimals(token1)
+        legacy_change_capital(bundle, token0, token1)
+    return {b: (bundles[b]["saldo"], bundles[b]["capitalRequirements"]) for b in bundles}
+
+def raw_accounting(swaps, coin_decimals):
+    # integer balances in Bundles, scaled once per bundle at the end, as the v2 swap branch of process_bundles does
+    token_table = TokenTable(coin_decimals)
+    bundles = {}
+    for b, token0, token1, amount0In, amount1In, amount0Out, amount1Out in swaps:
+        if not b in bundles:
+            bundles[b] = Bundle()
+            bundles[b].start(token_table, [token0, token1, "eth"])
+        bundle = bundles[b]
+        bundle.a_uniswapV2 += 1
+        bundle.add_pair(token0, token1, amount0Out - amount0In, amount1Out - amount1In)
+    return {b: bundles[b].balances() for b in bundles}
+
+def bench_accounting(sizes=((10, 3), (50, 10), (200, 30), (1000, 50)), repeat=200):
+    # (swaps, bundles) of one block, from a quiet block to a very busy one
+    for n, n_bundles in sizes:
+        swaps, decimals = synthetic_swaps(n_bundles, n, seed=n)
+        coin_decimals = decimals_lookup(decimals)
+        legacy = legacy_accounting(swaps, coin_decimals)
+        raw = raw_accounting(swaps, coin_decimals)
+        for b in legacy:
+            for i in range(2):
+                assert list(legacy[b][i]) == list(raw[b][i])
+                assert all(abs(legacy[b][i][t] - raw[b][i][t]) <= 1e-9 * max(1, abs(raw[b][i][t])) for t in raw[b][i])
+        t_legacy = min(timeit.repeat(lambda: legacy_accounting(swaps, coin_decimals), number=1, repeat=repeat))
+        t_raw = min(timeit.repeat(lambda: raw_accounting(swaps, coin_decimals), number=1, repeat=repeat))
+        print("accounting, {} swaps, {} bundles: legacy {:.0f} swaps/s, raw {:.0f} swaps/s, x{:.1f}".format(
+            n, len(raw), n / t_legacy, n / t_raw, t_legacy / t_raw))
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2 or sys.argv[1] == "detector":
+        bench_detector()
+    if len(sys.argv) < 2 or sys.argv[1] == "accounting":
+        bench_accounting()
@@ -0,0 +1,40 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+from web3 import Web3
+
+BLOOM_BYTES = 256
+
+def _to_bytes(value):
+    if isinstance(value, str):
+        return bytes.fromhex(value[2:] if value[:2] == "0x" else value)
+    return bytes(value)
+
+def bloom_bits(value):
+    # the three 11-bit positions a log address or topic sets in a 2048-bit logsBloom
+    h = Web3.keccak(_to_bytes(value))
+    return tuple(((h[i] << 8) | h[i+1]) & 2047 for i in (0, 2, 4))
+
+def address_topic(address):
+    # an address as it appears in an indexed event argument
+    return b"\x00" * 12 + _to_bytes(address)
+
+def bloom_add(bloom, value):
+    for bit in bloom_bits(value):
+        bloom[BLOOM_BYTES - 1 - bit // 8] |= 1 << (bit % 8)
+
+def bloom_test_bits(bloom, bits):
+    for bit in bits:
+        if not bloom[BLOOM_BYTES - 1 - bit // 8] & (1 << (bit % 8)):
+            return False
+    return True
+
+def bloom_contains(bloom, value):
+    return bloom_test_bits(_to_bytes(bloom), bloom_bits(value))
+
+def bloom_contains_any(bloom, bits_list):
+    bloom = _to_bytes(bloom)
+    for bits in bits_list:
+        if bloom_test_bits(bloom, bits):
+            return True
+    return False
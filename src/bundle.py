@@ -0,0 +1,257 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+FIELDS = ("transactions", "a_innerTxNumber", "directBribe", "gasBurnt", "gasOverpay", "min_index", "max_index",
+          "rates", "txs", "a_mintBurnV3", "a_mintBurnNFT", "a_uniswapV2", "a_uniswapV3", "a_pancakeV3",
+          "a_irreducibleTokens", "a_baseToken", "capitalRequirements_1", "totalCapital", "profitEstimation",
+          "ETHCapital", "ETHTotal", "a_startToken", "a_complexity", "a_N_startTokens", "beforeBribes", "bribesRatio",
+          "bundleId")
+TOKEN_FIELDS = ("saldo", "capitalRequirements")
+# mapping access dispatches on these with one hash lookup
+SLOT_FIELDS = frozenset(FIELDS)
+TOKEN_VALUES = {"saldo": "saldo_values", "capitalRequirements": "capital_values"}
+
+class TokenTable:
+    # token -> divisor of its raw amounts, shared by all bundles of a block,
+    # decimals(token) is looked up once per token
+    __slots__ = ("decimals", "scales")
+
+    def __init__(self, decimals=None):
+        self.decimals = decimals
+        self.scales = {}
+
+    def scale(self, token):
+        s = self.scales.get(token)
+        if s is None:
+            s = self.scales[token] = 1 if self.decimals is None else self.decimals(token)
+        return s
+
+class TokenValues:
+    # dict-like view of one of the bundle's raw amount dicts scaled by the token decimals,
+    # tokens iterate in the order they were added
+    __slots__ = ("bundle", "values")
+
+    def __init__(self, bundle, values):
+        self.bundle = bundle
+        self.values = values
+
+    def __getitem__(self, token):
+        return self.values[token] / self.bundle.table.scale(token)
+
+    def __setitem__(self, token, value):
+        self.bundle.add_tokens(token)
+        self.values[token] = value * self.bundle.table.scale(token)
+
+    def __contains__(self, token):
+        return token in self.values
+
+    def __iter__(self):
+        return iter(self.values)
+
+    def __len__(self):
+        return len(self.values)
+
+    def keys(self):
+        return list(self.values)
+
+    def items(self):
+        table = self.bundle.table
+        scales = table.scales
+        values = self.values
+        return [(token, values[token] / (scales.get(token) or table.scale(token))) for token in values]
+
+    def to_dict(self):
+        return dict(self.items())
+
+class Bundle:
+    # per-block bundle accumulator, balances and capital requirements are exact raw integer amounts in dicts
+    # with the same tokens in the same order, scaled by the decimals only when read,
+    # gas and bribes are summed in wei as well,
+    # other fields are slots, the dict protocol keeps the db layer and the attack classes working unchanged
+    __slots__ = FIELDS + ("table", "saldo_values", "capital_values", "gas_wei", "extra")
+
+    def __init__(self, **fields):
+        self.table = None
+        self.saldo_values = None
+        self.extra = {}
+        for k in fields:
+            self[k] = fields[k]
+
+    def init_tokens(self, table):
+        self.table = table
+        self.saldo_values = {}
+        self.capital_values = {}
+
+    def start(self, table, tokens):
+        self.table = table
+        self.saldo_values = dict.fromkeys(tokens, 0)
+        self.capital_values = dict.fromkeys(tokens, 0)
+        self.rates = {}
+        self.directBribe = 0
+        self.gasBurnt = 0
+        self.gasOverpay = 0
+        # gasBurnt, gasOverpay, directBribe
+        self.gas_wei = [0, 0, 0]
+        self.txs = set()
+        self.a_mintBurnV3 = 0
+        self.a_mintBurnNFT = 0
+        self.a_uniswapV2 = 0
+        self.a_uniswapV3 = 0
+        self.a_pancakeV3 = 0
+
+    def add_tokens(self, *tokens):
+        saldo = self.saldo_values
+        for token in tokens:
+            if not token in saldo:
+                saldo[token] = 0
+                self.capital_values[token] = 0
+
+    def add(self, token, amount):
+        self.saldo_values[token] += amount
+
+    def add_pair(self, token0, token1, amount0, amount1):
+        # both sides of a swap or a liquidity change, tokens new to the bundle are added,
+        # the capital requirements follow the new balances
+        saldo = self.saldo_values
+        capital = self.capital_values
+        s0 = saldo.get(token0)
+        if s0 is None:
+            s0 = capital[token0] = 0
+        s0 = saldo[token0] = s0 + amount0
+        s1 = saldo.get(token1)
+        if s1 is None:
+            s1 = capital[token1] = 0
+        s1 = saldo[token1] = s1 + amount1
+        if s0 < -capital[token0]:
+            capital[token0] = -s0
+        if s1 < -capital[token1]:
+            capital[token1] = -s1
+
+    def change_capital(self, *tokens):
+        for token in tokens:
+            if self.saldo_values[token] < -self.capital_values[token]:
+                self.capital_values[token] = -self.saldo_values[token]
+
+    def update_gas(self, transaction):
+        if not transaction["hash"] in self.txs:
+            self.txs.add(transaction["hash"])
+            gas_wei = self.gas_wei
+            gas_burnt = int(transaction["gasBurnt"])
+            gas_overpay = int(transaction["gasOverpay"])
+            gas_wei[0] += gas_burnt
+            gas_wei[1] += gas_overpay
+            self.gasBurnt = gas_wei[0] / 1e18
+            self.gasOverpay = gas_wei[1] / 1e18
+            spent = gas_burnt + gas_overpay
+            if "directBribe" in transaction:
+                direct_bribe = int(transaction["directBribe"])
+                gas_wei[2] += direct_bribe
+                self.directBribe = gas_wei[2] / 1e18
+                spent += direct_bribe
+            saldo = self.saldo_values["eth"] - spent
+            self.saldo_values["eth"] = saldo
+            if saldo < -self.capital_values["eth"]:
+                self.capital_values["eth"] = -saldo
+
+    def balances(self):
+        # saldo and capital requirements scaled by the decimals, in one pass
+        table = self.table
+        scales = table.scales
+        capital_values = self.capital_values
+        saldo = {}
+        capital = {}
+        for token, value in self.saldo_values.items():
+            scale = scales.get(token) or table.scale(token)
+            saldo[token] = value / scale
+            capital[token] = capital_values[token] / scale
+        return saldo, capital
+
+    @classmethod
+    def from_dict(cls, d, table=None, exclude=()):
+        # a plain dict bundle, as the db layer returns it, token fields stored as null stay unset
+        bundle = cls()
+        bundle.table = table
+        for k in d:
+            if not k in exclude and not (k in TOKEN_FIELDS and d[k] is None):
+                bundle[k] = d[k]
+        return bundle
+
+    def copy(self):
+        bundle = Bundle()
+        for k in FIELDS:
+            if hasattr(self, k):
+                setattr(bundle, k, getattr(self, k))
+        bundle.extra = dict(self.extra)
+        if not self.saldo_values is None:
+            bundle.table = self.table
+            bundle.saldo_values = dict(self.saldo_values)
+            bundle.capital_values = dict(self.capital_values)
+            bundle.gas_wei = list(self.gas_wei)
+        return bundle
+
+    def __getitem__(self, key):
+        if key in SLOT_FIELDS:
+            try:
+                return getattr(self, key)
+            except AttributeError:
+                raise KeyError(key)
+        values = TOKEN_VALUES.get(key)
+        if values is None:
+            return self.extra[key]
+        if self.saldo_values is None:
+            raise KeyError(key)
+        return TokenValues(self, getattr(self, values))
+
+    def __setitem__(self, key, value):
+        if key in SLOT_FIELDS:
+            setattr(self, key, value)
+            return
+        values = TOKEN_VALUES.get(key)
+        if values is None:
+            self.extra[key] = value
+            return
+        # a plain dict, as loaded from the db, is copied into the raw amounts
+        if self.saldo_values is None:
+            self.init_tokens(self.table if not self.table is None else TokenTable())
+            # amounts already set in ETH carry on in wei
+            self.gas_wei = [int(round((getattr(self, k, None) or 0) * 10**18)) for k in ("gasBurnt", "gasOverpay", "directBribe")]
+        values = TokenValues(self, getattr(self, values))
+        for token in value:
+            values[token] = value[token]
+
+    def __contains__(self, key):
+        if key in SLOT_FIELDS:
+            return hasattr(self, key)
+        if key in TOKEN_VALUES:
+            return not self.saldo_values is None
+        return key in self.extra
+
+    def __iter__(self):
+        for k in FIELDS[:7]:
+            if hasattr(self, k):
+                yield k
+        if not self.saldo_values is None:
+            yield from TOKEN_FIELDS
+        for k in FIELDS[7:]:
+            if hasattr(self, k):
+                yield k
+        yield from self.extra
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+
+    def keys(self):
+        return list(self)
+
+    def items(self):
+        return [(k, self[k]) for k in self]
+
+    def to_dict(self):
+        # the plain dict the db layer and classes_and_emas were written for
+        d = {}
+        for k in self:
+            d[k] = self[k].to_dict() if k in TOKEN_FIELDS else self[k]
+        return d
+
+def bundles_to_dicts(bundles):
+    return {b: bundles[b].to_dict() if isinstance(bundles[b], Bundle) else bundles[b] for b in bundles}
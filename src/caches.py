@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import time
+import threading
+from collections import OrderedDict
+
+NEGATIVE_TTL = 86400
+
+class NegativeCache:
+    # addresses whose lookup failed for good, skipped until their expiry,
+    # new entries are written to t_bad_contracts on flush so a restart keeps them
+    def __init__(self, kind, ttl=NEGATIVE_TTL, stats=None):
+        self.kind = kind
+        self.ttl = ttl
+        self.stats = stats if not stats is None else {}
+        self.expires = {}
+        self.new_entries = {}
+        self.lock = threading.Lock()
+
+    def _count(self, name):
+        name = self.kind + name
+        self.stats[name] = self.stats.get(name, 0) + 1
+
+    def __contains__(self, address):
+        address = address.lower()
+        expires = self.expires.get(address)
+        if expires is None or expires < time.time():
+            self._count("_negative_misses")
+            return False
+        self._count("_negative_hits")
+        return True
+
+    def __len__(self):
+        return len(self.expires)
+
+    def add(self, address, reason=None):
+        address = address.lower()
+        expires = int(time.time() + self.ttl)
+        with self.lock:
+            self.expires[address] = expires
+            self.new_entries[address] = (expires, None if reason is None else reason[:1024])
+
+    def load(self, db):
+        now = time.time()
+        for r in db.get_bad_contracts(self.kind):
+            if r["expires"] >= now:
+                self.expires[r["address"]] = r["expires"]
+
+    def flush(self, db):
+        with self.lock:
+            new_entries, self.new_entries = self.new_entries, {}
+        if len(new_entries):
+            db.add_bad_contracts([(a, self.kind, new_entries[a][0], new_entries[a][1]) for a in new_entries])
+
+class LRUCache:
+    # dict-like cache bounded by its number of items, least recently used entries are evicted first
+    def __init__(self, name, max_items=None, stats=None):
+        self.name = name
+        self.max_items = max_items
+        self.stats = stats if not stats is None else {}
+        self.items = OrderedDict()
+        self.lock = threading.RLock()
+
+    def _count(self, name, n=1):
+        name = self.name + name
+        self.stats[name] = self.stats.get(name, 0) + n
+
+    def get(self, key, default=None):
+        with self.lock:
+            if key in self.items:
+                self.items.move_to_end(key)
+                self._count("_hits")
+                return self.items[key]
+        self._count("_misses")
+        return default
+
+    def __contains__(self, key):
+        return not self.get(key) is None
+
+    def __getitem__(self, key):
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        with self.lock:
+            self.items[key] = value
+            self.items.move_to_end(key)
+            evicted = 0
+            while not self.max_items is None and len(self.items) > max(self.max_items, 1):
+                self.items.popitem(last=False)
+                evicted += 1
+        if evicted:
+            self._count("_evictions", evicted)
+
+    def __len__(self):
+        return len(self.items)
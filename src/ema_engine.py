@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import time
+
+from attack_rules import compile_attack_classes
+
+class EMAEngine:
+    # attack classes and t_attack_EMAs rows stay in memory, the (attackClassId, attacker) keys touched since the last
+    # flush are written back in one upsert every flush_blocks blocks or flush_seconds seconds,
+    # t_attacks is committed with every block, so a restart replays the attacks newer than the stored EMAs
+    def __init__(self, alpha, flush_blocks=100, flush_seconds=60):
+        self.alpha = alpha
+        self.flush_blocks = flush_blocks
+        self.flush_seconds = flush_seconds
+        self.attack_classes = []
+        self.emas = {}
+        self.dirty = set()
+        self.blocks = 0
+        self.flushed_at = time.time()
+        self.loaded = False
+
+    def load(self, db, replay=True):
+        self.attack_classes = compile_attack_classes(db.get_attack_classes())
+        self.emas = {(a["attackClassId"], a["attacker"]): a for a in db.get_attack_EMAs()}
+        self.dirty = set()
+        self.loaded = True
+        if replay:
+            # a flush writes every key touched up to its block, so all attacks up to the newest stored lastBlockNumber
+            # are in the EMAs and the later ones are replayed in block and bundle order
+            last_block_numbers = [a["lastBlockNumber"] for a in self.emas.values() if not a["lastBlockNumber"] is None]
+            attacks = db.get_attacks_after(max(last_block_numbers) if len(last_block_numbers) else -1)
+            for a in attacks:
+                self.update((a["attackClassId"], a["attacker"]), a["blockNumber"], a["bribesRatio"])
+            print("EMAs loaded", len(self.emas), "attacks replayed", len(attacks))
+
+    def rebuild(self, db):
+        # every EMA is folded again from all of t_attacks in block and bundle order,
+        # needed after attacks were written out of block order, as a backfill of older blocks does
+        self.emas = {}
+        attacks = db.get_attacks_after(-1)
+        for a in attacks:
+            self.update((a["attackClassId"], a["attacker"]), a["blockNumber"], a["bribesRatio"])
+        print("EMAs rebuilt", len(self.emas), "from attacks", len(attacks))
+
+    def update(self, key, block_number, bribes_ratio):
+        # the first attack of a key sets its EMA and counts 1, the count grows only when the EMA existed
+        if not key in self.emas:
+            self.emas[key] = {"countAttacks": 1,
+                              "lastBlockNumber": None,
+                              "bribesRatio": None,
+                              "bribesRatioEMA": None}
+        ema = self.emas[key]
+        if ema["bribesRatioEMA"] is None:
+            ema["bribesRatioEMA"] = bribes_ratio
+        else:
+            ema["bribesRatioEMA"] = bribes_ratio * self.alpha + ema["bribesRatioEMA"] * (1 - self.alpha)
+            ema["countAttacks"] += 1
+        ema["lastBlockNumber"] = block_number
+        ema["bribesRatio"] = bribes_ratio
+        self.dirty.add(key)
+
+    def classify(self, bundles, attakers_list, db):
+        if not self.loaded:
+            self.load(db)
+        for b in bundles:
+            if not "saldo" in bundles[b] or bundles[b]["saldo"] is None:
+                continue
+            report_by_attackers = ["*"]
+            for a in attakers_list:
+                if a["tx_to"] == b[2]:
+                    if a["report"] in [1, 2]:
+                        report_by_attackers.append(b[2])
+                else:
+                    if a["report"] == 2:
+                        report_by_attackers.append("~" + a["tx_to"])
+
+            for c in self.attack_classes:
+                if not bundles[b]["bribesRatio"] is None and c["predicate"](bundles[b]):
+                    for a in report_by_attackers:
+                        self.update((c["attackClassId"], a), b[0], bundles[b]["bribesRatio"])
+                        db.add_attack(bundles[b]["bundleId"], c["attackClassId"], a, b[0],
+                                      bundles[b]["bribesRatio"])
+        self.blocks += 1
+
+    def maybe_flush(self, db):
+        if self.blocks >= self.flush_blocks or time.time() - self.flushed_at >= self.flush_seconds:
+            self.flush(db)
+
+    def flush(self, db):
+        if len(self.dirty):
+            db.update_attack_EMAs([(key[0], key[1], self.emas[key]["countAttacks"], self.emas[key]["lastBlockNumber"],
+                                    self.emas[key]["bribesRatio"], self.emas[key]["bribesRatioEMA"]) for key in self.dirty])
+            print("EMAs flushed", len(self.dirty))
+        self.dirty = set()
+        self.blocks = 0
+        self.flushed_at = time.time()
+        # class definitions edited meanwhile are picked up here
+        if self.loaded:
+            self.attack_classes = compile_attack_classes(db.get_attack_classes())
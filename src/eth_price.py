@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import time
+import threading
+from datetime import datetime, timezone
+from bisect import bisect_right
+
+from etherscan import etherscan_get_ethusd
+
+DAY = 86400
+REFRESH_INTERVAL = 60
+
+class EthPriceError(Exception):
+    pass
+
+class EthPriceService:
+    # ETH/USD history as sorted (timestamp, price) points, blocks newer than the last point use the live price
+    def __init__(self, etherscan_key, refresh_interval=REFRESH_INTERVAL):
+        self.etherscan_key = etherscan_key
+        self.refresh_interval = refresh_interval
+        self.timestamps = []
+        self.prices = []
+        self.live_price = None
+        self.history_until = None
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def set_history(self, rows, historical=False):
+        # historical: the run prices past blocks only, blocks up to a day ago are priced from the stored history
+        # even past its last point, the live price is for the newest blocks
+        rows = sorted((int(r["timestamp"]), float(r["price"])) for r in rows)
+        with self.lock:
+            self.timestamps = [r[0] for r in rows]
+            self.prices = [r[1] for r in rows]
+            if historical:
+                self.history_until = time.time() - DAY
+
+    def missing_days(self, start_day, end_day):
+        # (first_day, last_day) ranges without a stored point, before, between and after the stored ones
+        days = set(t // DAY * DAY for t in self.timestamps)
+        missing = []
+        first_day = None
+        for day in range(start_day, end_day + DAY, DAY):
+            if day in days:
+                if not first_day is None:
+                    missing.append((first_day, day - DAY))
+                    first_day = None
+            elif first_day is None:
+                first_day = day
+        if not first_day is None:
+            missing.append((first_day, end_day))
+        return missing
+
+    def preload(self, db, start_timestamp, end_timestamp=None, historical=False):
+        # days missing in t_eth_prices between start and yesterday are fetched once and stored,
+        # days that cannot be fetched are priced from the nearest earlier stored day,
+        # a historical run with no stored day at all cannot be priced and is refused
+        if end_timestamp is None:
+            end_timestamp = time.time() - DAY
+        self.set_history(db.get_eth_prices(), historical)
+        start_day = int(start_timestamp) // DAY * DAY
+        end_day = int(end_timestamp) // DAY * DAY
+        rows = []
+        unavailable = []
+        for first_day, last_day in self.missing_days(start_day, end_day):
+            try:
+                result = etherscan_get_ethusd(self.etherscan_key, datetime.fromtimestamp(first_day, timezone.utc),
+                                              datetime.fromtimestamp(last_day, timezone.utc))
+            except Exception as e:
+                result = e
+            if not isinstance(result, list):
+                unavailable.append((first_day, last_day, result))
+                continue
+            rows.extend({"timestamp": int(r["unixTimeStamp"]), "price": float(r["value"])} for r in result)
+        if len(rows):
+            db.add_eth_prices(rows)
+            db.commit()
+            self.set_history(rows + [{"timestamp": t, "price": p} for t, p in zip(self.timestamps, self.prices)], historical)
+        if len(unavailable) and not len(self.timestamps):
+            if historical:
+                raise EthPriceError("no eth daily prices stored or available: " + repr(unavailable[0][2]))
+            print("WARNING no eth daily prices stored or available, the live price is used")
+        for first_day, last_day, result in unavailable:
+            print("WARNING eth daily prices from " + datetime.fromtimestamp(first_day, timezone.utc).date().isoformat() +
+                  " to " + datetime.fromtimestamp(last_day, timezone.utc).date().isoformat() + " not available: " +
+                  repr(result) + ", the nearest earlier stored price is used")
+        return unavailable
+
+    def refresh(self):
+        # the request runs outside the lock, a failed one keeps the last known price
+        try:
+            price = float(etherscan_get_ethusd(self.etherscan_key)["ethusd"])
+        except Exception as e:
+            print("eth price refresh error", repr(e))
+            return False
+        with self.lock:
+            self.live_price = price
+        return True
+
+    def _refresh_loop(self):
+        while not self.stop_event.wait(self.refresh_interval):
+            self.refresh()
+
+    def start(self):
+        self.refresh()
+        self.thread = threading.Thread(target=self._refresh_loop, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stop_event.set()
+
+    def get_rate(self, timestamp=None):
+        with self.lock:
+            if not (timestamp is None or not len(self.timestamps) or
+                    timestamp >= max(self.timestamps[-1] + DAY, self.history_until or 0)):
+                i = bisect_right(self.timestamps, timestamp) - 1
+                return self.prices[max(i, 0)]
+            live_price = self.live_price
+        if live_price is None:
+            self.refresh()
+            live_price = self.live_price
+            if live_price is None:
+                raise EthPriceError("no eth price")
+        return live_price
@@ -1,14 +1,27 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
-import requests
+import os
+import json
 import time
+import random
+import hashlib
+import threading
+import requests
 from web3 import Web3
 from token_abi import token_abi
 from UniswapV2Pair import pair_abi
 from UniswapV3Pool import pool_abi
 
 MAX_RETRY = 10
+RATE = 5
+POOL_SIZE = 16
+TIMEOUT = 30
+BACKOFF_BASE = 0.25
+BACKOFF_MAX = 30
+ABI_TTL = 30 * 86400
+INTERNALS_TTL = None
+MAX_INTERNALS = 10000
 USDC_LIKE = ["0xA0b86991c6218b36c1d19D4a2e9Eb0cE3606eB48".lower(), '0x0000000000085d4780b73119b644ae5ecd22b376'.lower()]
 HEADERS = {'Content-Type': "application/json"}
 ETHERSCAN_GETABI = 'http://api.etherscan.io/api?module=contract&action=getabi&address={}&apikey={}'
@@ -17,53 +30,166 @@ ETHERSCAN_GETINTERNALS_TX = 'http://api.etherscan.io/api?module=account&action=t
 ETHERSCAN_GETETHUSD_DAILY = 'https://api.etherscan.io/api?module=stats&action=ethdailyprice&startdate={:%Y-%m-%d}&enddate={:%Y-%m-%d}&sort=asc&apikey={}'
 ETHERSCAN_GETETHUSD_LAST = 'https://api.etherscan.io/api?module=stats&action=ethprice&apikey={}'
 
-def etherscan_get_ethusd(etherscan_key, startdate=None, enddate=None):
-    if startdate is None:
-        etherscan_request = ETHERSCAN_GETETHUSD_LAST.format(etherscan_key)
-    else:
-        etherscan_request = ETHERSCAN_GETETHUSD_DAILY.format(startdate, enddate, etherscan_key)
-    res = requests.get(etherscan_request, headers=HEADERS)
-    d = res.json()
-    return d["result"]
-
-def etherscan_get_internals(etherscan_key, block_number, address=None, txhash=None, session=None):
-    if address:
-        param = address
-        etherscan_request = ETHERSCAN_GETINTERNALS
-    elif txhash:
-        param = txhash
-        etherscan_request = ETHERSCAN_GETINTERNALS_TX
-    try:
-        if session:
-            res = session.get(etherscan_request.format(param, block_number, block_number, etherscan_key), headers=HEADERS)
-            d = res.json()
-            if d["result"] == 'Max rate limit reached':
-                time.sleep(0.2)
-                res = session.get(etherscan_request.format(param, block_number, block_number, etherscan_key), headers=HEADERS, force_refresh=True)
-                d = res.json()
-        else:
-            res = requests.get(etherscan_request.format(param, block_number, block_number, etherscan_key), headers=HEADERS)
-            d = res.json()
+class EtherscanError(Exception):
+    pass
+
+class TokenBucket:
+    # shared by every thread of the process, calls wait for a token instead of hitting the api limit
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity if not capacity is None else rate)
+        self.tokens = self.capacity
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+                self.last = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+class DiskCache:
+    # one json file per answer, ttl None keeps it forever
+    def __init__(self, cache_dir):
+        self.cache_dir = os.path.expanduser(cache_dir)
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, hashlib.sha1(key.encode()).hexdigest() + ".json")
+
+    def get(self, key):
+        try:
+            with open(self._path(key), "r") as f:
+                d = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if not d["expires"] is None and d["expires"] < time.time():
+            return None
         return d["result"]
-    except:
-        print("etherscan error", res.status_code)
+
+    def set(self, key, result, ttl=None):
+        path = self._path(key)
+        tmp_path = path + ".{}.tmp".format(os.getpid())
+        with open(tmp_path, "w") as f:
+            json.dump({"expires": None if ttl is None else time.time() + ttl, "result": result}, f)
+        os.replace(tmp_path, path)
+
+class EtherscanClient:
+    def __init__(self, etherscan_key, rate=RATE, cache_dir=None, abi_ttl=ABI_TTL, internals_ttl=INTERNALS_TTL, max_retry=MAX_RETRY):
+        self.etherscan_key = etherscan_key
+        self.bucket = TokenBucket(rate)
+        self.cache = DiskCache(cache_dir) if cache_dir else None
+        self.abi_ttl = abi_ttl
+        self.internals_ttl = internals_ttl
+        self.max_retry = max_retry
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def request(self, url):
+        # rate limit answers, http and connection errors are retried with exponential backoff,
+        # any other answer is returned as is
+        for i in range(self.max_retry):
+            self.bucket.acquire()
+            try:
+                res = self.session.get(url, headers=HEADERS, timeout=TIMEOUT)
+                if res.status_code == 200:
+                    d = res.json()
+                    if not (d.get("status") == "0" and "rate limit" in str(d.get("result"))):
+                        return d
+                    error = d["result"]
+                else:
+                    error = res.status_code
+            except (requests.exceptions.RequestException, ValueError) as e:
+                error = e
+            delay = min(BACKOFF_MAX, BACKOFF_BASE * 2 ** i) * (1 + random.random()) / 2
+            print("etherscan retry", i, error, "{:.2f}s".format(delay))
+            time.sleep(delay)
         return None
 
+    def _cached_request(self, url, cache_key, ttl, is_final):
+        if not self.cache is None and cache_key:
+            d = self.cache.get(cache_key)
+            if not d is None:
+                return d
+        d = self.request(url)
+        if not d is None and not self.cache is None and cache_key and is_final(d):
+            self.cache.set(cache_key, d, ttl)
+        return d
+
+    def get_abi(self, address):
+        # only verified sources are cached, an unverified contract can be verified later
+        d = self._cached_request(ETHERSCAN_GETABI.format(address, self.etherscan_key), "abi/" + address.lower(),
+                                 self.abi_ttl, lambda d: d.get("status") == "1")
+        if d is None:
+            raise EtherscanError("no answer for getabi " + address)
+        if d.get("status") != "1":
+            return None
+        return d["result"]
+
+    def get_internals(self, block_number, address=None, txhash=None, end_block=None, cache=False):
+        # cache: the range is deep enough in the chain not to change anymore
+        if end_block is None:
+            end_block = block_number
+        if address:
+            url = ETHERSCAN_GETINTERNALS.format(address, block_number, end_block, self.etherscan_key)
+            cache_key = "internals/{}/{}/{}".format(address.lower(), block_number, end_block)
+        elif txhash:
+            url = ETHERSCAN_GETINTERNALS_TX.format(txhash, block_number, end_block, self.etherscan_key)
+            cache_key = "internals_tx/{}".format(txhash.lower())
+        else:
+            return None
+        d = self._cached_request(url, cache_key if cache else None, self.internals_ttl,
+                                 lambda d: isinstance(d.get("result"), list))
+        return None if d is None else d["result"]
+
+    def get_ethusd(self, startdate=None, enddate=None):
+        if startdate is None:
+            d = self.request(ETHERSCAN_GETETHUSD_LAST.format(self.etherscan_key))
+        else:
+            d = self.request(ETHERSCAN_GETETHUSD_DAILY.format(startdate, enddate, self.etherscan_key))
+        return None if d is None else d["result"]
+
+_client = None
+
+def configure_client(etherscan_key, **kwargs):
+    # one client per process, worker processes configure their own with their share of the rate
+    global _client
+    _client = EtherscanClient(etherscan_key, **kwargs)
+    return _client
+
+def get_client(etherscan_key):
+    if _client is None or _client.etherscan_key != etherscan_key:
+        return configure_client(etherscan_key)
+    return _client
+
+def etherscan_get_ethusd(etherscan_key, startdate=None, enddate=None):
+    return get_client(etherscan_key).get_ethusd(startdate, enddate)
+
+def etherscan_get_internals(etherscan_key, block_number, address=None, txhash=None, end_block=None, cache=False):
+    return get_client(etherscan_key).get_internals(block_number, address=address, txhash=txhash, end_block=end_block, cache=cache)
+
 def _get_abi(address, etherscan_key):
-    try:
-        res = requests.get(ETHERSCAN_GETABI.format(address, etherscan_key), headers=HEADERS)
-        d = res.json()
-        abi = d["result"]
-        return abi
-    except:
-        return None
+    return get_client(etherscan_key).get_abi(address)
 
 def _get_contract(w3, abi, address):
     return w3.eth.contract(address=address, abi=abi)
 
 def get_contract_sync(address, context=None, w3=None, abi_type=None):
-    if address in context["contract_storage"]:
-        return context["contract_storage"][address], context["abi_storage"][address]
+    # full Contract objects for tools that need more than token0()/token1(),
+    # the block pipeline reads pool tokens with raw selector calls and never comes here
+    contract, abi = context["contract_storage"].get(address), context["abi_storage"].get(address)
+    if not contract is None and not abi is None:
+        return contract, abi
+    if "bad_abis" in context and address in context["bad_abis"]:
+        return None, None
         
     _address = Web3.to_checksum_address(address)
     abi = None
@@ -77,14 +203,12 @@ def get_contract_sync(address, context=None, w3=None, abi_type=None):
         elif abi_type == "pool":
             abi = pool_abi        
     if abi is None:
-        for i in range(MAX_RETRY):
-            if not abi is None:
-                break
-            abi = _get_abi(_address, context["etherscan_key"])
-           
-            if not abi and i < MAX_RETRY-1:
-                time.sleep(1)
-        else:
+        # retries and rate limiting are done by the client, None is a definitive answer,
+        # EtherscanError is raised when the retries run out
+        abi = _get_abi(_address, context["etherscan_key"])
+        if abi is None:
+            if "bad_abis" in context:
+                context["bad_abis"].add(address, "no verified abi")
             return None, None
     try:
         contract = _get_contract(w3, abi, _address)
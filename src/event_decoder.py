@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+from typing import NamedTuple, Optional
+
+ZERO_TOPIC = "0x" + "00" * 32
+
+class V2Swap(NamedTuple):
+    amount0In: int
+    amount1In: int
+    amount0Out: int
+    amount1Out: int
+
+class V3Swap(NamedTuple):
+    amount0: int
+    amount1: int
+
+class LiquidityChange(NamedTuple):
+    amount0: int
+    amount1: int
+
+class WethAmount(NamedTuple):
+    amount: int
+
+class Transfer(NamedTuple):
+    mintBurn: bool
+    toToken: bool
+    value: Optional[int]
+
+def _data(event):
+    data = event["data"]
+    return bytes.fromhex(data[2:] if data[:2] == "0x" else data)
+
+def _words(data, *positions):
+    # None when the data is too short for the last word asked for
+    if len(data) < 32 * (max(positions) + 1):
+        return None
+    return [int.from_bytes(data[32*i:32*i+32], "big") for i in positions]
+
+def _signed(q):
+    return q - (1 << 256) if q >> 255 else q
+
+def decode_v2_swap(event):
+    words = _words(_data(event), 0, 1, 2, 3)
+    return None if words is None else V2Swap(*words)
+
+def decode_v3_swap(event):
+    # uniswap and pancake v3 swaps start with the signed amount0, amount1
+    words = _words(_data(event), 0, 1)
+    return None if words is None else V3Swap(_signed(words[0]), _signed(words[1]))
+
+def decode_mint(event):
+    # sender, amount, amount0, amount1
+    words = _words(_data(event), 2, 3)
+    return None if words is None else LiquidityChange(*words)
+
+def decode_collect(event):
+    # recipient, amount0, amount1
+    words = _words(_data(event), 1, 2)
+    return None if words is None else LiquidityChange(*words)
+
+def decode_weth_amount(event):
+    # the amount is the data, or the second indexed argument for contracts that index it
+    data = _data(event)
+    if len(data):
+        return WethAmount(int.from_bytes(data, "big"))
+    if len(event["topics"]) > 2:
+        return WethAmount(int(event["topics"][2], 16))
+    return WethAmount(0)
+
+def decode_transfer(event):
+    topics = event["topics"]
+    data = _data(event)
+    return Transfer((len(topics) > 1 and topics[1] == ZERO_TOPIC) or (len(topics) > 2 and topics[2] == ZERO_TOPIC),
+                    len(topics) > 2 and topics[2][-40:] == event["address"][-40:].lower(),
+                    int.from_bytes(data, "big") if len(data) else None)
+
+DECODERS = {"a_uniswapV2": decode_v2_swap,
+            "a_uniswapV3": decode_v3_swap,
+            "a_pancakeV3": decode_v3_swap,
+            "mint": decode_mint,
+            "collect": decode_collect,
+            "withdraw": decode_weth_amount,
+            "deposit": decode_weth_amount,
+            "transfer": decode_transfer}
+
+def decode_event(kind, event):
+    return DECODERS[kind](event)
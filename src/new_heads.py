@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import asyncio
+import json
+import websockets
+
+RESUBSCRIBE_DELAY = 1
+MAX_RESUBSCRIBE_DELAY = 30
+PING_INTERVAL = 20
+
+class SubscriptionError(Exception):
+    pass
+
+async def _subscribe(ws, params):
+    await ws.send(json.dumps({"jsonrpc": "2.0", "id": 1, "method": "eth_subscribe", "params": params}))
+    while True:
+        reply = json.loads(await ws.recv())
+        if reply.get("id") == 1:
+            break
+    if "error" in reply:
+        raise SubscriptionError(reply["error"])
+    return reply["result"]
+
+async def subscribe_new_heads(wss_url, on_head):
+    # calls on_head(header) for every new head, reconnects and resubscribes with backoff when the socket drops
+    delay = RESUBSCRIBE_DELAY
+    while True:
+        try:
+            async with websockets.connect(wss_url, ping_interval=PING_INTERVAL) as ws:
+                subscription = await _subscribe(ws, ["newHeads"])
+                print("subscribed to newHeads", subscription)
+                delay = RESUBSCRIBE_DELAY
+                async for message in ws:
+                    try:
+                        m = json.loads(message)
+                        if m.get("method") != "eth_subscription" or m["params"]["subscription"] != subscription:
+                            continue
+                        header = m["params"]["result"]
+                        int(header["number"], 16)
+                    except (ValueError, KeyError, TypeError, AttributeError) as e:
+                        # a malformed notification is skipped, the next head brings the missed blocks along
+                        print("newHeads message skipped", repr(e), str(message)[:200])
+                        continue
+                    await on_head(header)
+        except (websockets.WebSocketException, OSError, SubscriptionError, asyncio.TimeoutError) as e:
+            # dropped connections and refused handshakes (a 503 while the node restarts) alike
+            print("newHeads subscription lost", repr(e))
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, MAX_RESUBSCRIBE_DELAY)
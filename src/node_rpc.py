@@ -0,0 +1,263 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import requests
+from eth_abi import encode, decode
+from hexbytes import HexBytes
+from web3 import Web3
+
+HEADERS = {'Content-Type': "application/json"}
+RPC_TIMEOUT = 30
+MAX_BATCH = 100
+MULTICALL3 = "0xcA11bde05977b3631167028862bE2a173976CA11"
+MULTICALL_BATCH = 500
+AGGREGATE3_SELECTOR = bytes.fromhex("82ad56cb")
+TOKEN0_SELECTOR = bytes.fromhex("0dfe1681")
+TOKEN1_SELECTOR = bytes.fromhex("d21220a7")
+DECIMALS_SELECTOR = bytes.fromhex("313ce567")
+INT_FIELDS = ["number", "timestamp", "baseFeePerGas", "gasLimit", "gasUsed", "transactionIndex", "blockNumber",
+              "gasPrice", "maxFeePerGas", "maxPriorityFeePerGas", "value", "gas", "nonce", "type", "chainId"]
+
+class RPCError(Exception):
+    pass
+
+class ContractDataError(Exception):
+    # the call went through but returned nothing usable
+    pass
+
+UNSUPPORTED_METHOD = -32601
+UNSUPPORTED_MESSAGES = ("method not found", "not supported", "unsupported", "does not exist", "not available")
+
+def is_unsupported_method(e):
+    # the node does not serve the method at all, as opposed to failing this one call
+    error = e.args[0] if len(e.args) else None
+    if isinstance(error, dict):
+        if error.get("code") == UNSUPPORTED_METHOD:
+            return True
+        message = str(error.get("message", "")).lower()
+    else:
+        message = str(error).lower()
+    return any(m in message for m in UNSUPPORTED_MESSAGES)
+
+def _hex(v):
+    return v if isinstance(v, str) else v.hex()
+
+def _int(v):
+    return int(v, 16) if isinstance(v, str) else v
+
+def rpc_request(w3, method, params):
+    res = w3.provider.make_request(method, params)
+    if "error" in res:
+        raise RPCError(res["error"])
+    return res["result"]
+
+def rpc_batch(w3, calls):
+    # plain JSON-RPC batch over the provider url, web3 v6 has no batching of its own
+    results = []
+    for i in range(0, len(calls), MAX_BATCH):
+        payload = [{"jsonrpc": "2.0", "id": i + j, "method": c[0], "params": c[1]} for j, c in enumerate(calls[i:i+MAX_BATCH])]
+        res = requests.post(w3.provider.endpoint_uri, json=payload, headers=HEADERS, timeout=RPC_TIMEOUT)
+        d = res.json()
+        if not isinstance(d, list):
+            raise RPCError(d.get("error", d))
+        d = {r["id"]: r for r in d}
+        for j in range(len(payload)):
+            r = d.get(i + j)
+            results.append(r["result"] if not r is None and "result" in r else None)
+    return results
+
+def format_log(log):
+    return {"address": Web3.to_checksum_address(log["address"]),
+            "blockHash": _hex(log["blockHash"]),
+            "blockNumber": _int(log["blockNumber"]),
+            "transactionHash": _hex(log["transactionHash"]),
+            "transactionIndex": _int(log["transactionIndex"]),
+            "logIndex": _int(log["logIndex"]),
+            "data": _hex(log["data"]),
+            "topics": [_hex(t) for t in log["topics"]],
+            "removed": log.get("removed", False)}
+
+def format_receipt(receipt):
+    # the same shape for raw json and web3 formatted receipts: ints and 0x-strings
+    return {"transactionHash": _hex(receipt["transactionHash"]),
+            "status": _int(receipt["status"]),
+            "gasUsed": _int(receipt["gasUsed"]),
+            "effectiveGasPrice": _int(receipt["effectiveGasPrice"]),
+            "logs": [format_log(l) for l in receipt["logs"]]}
+
+def get_block_receipts(w3, block_number, transaction_hashes=None):
+    receipts = rpc_request(w3, "eth_getBlockReceipts", [hex(block_number)])
+    if receipts is None:
+        return None
+    return {r["transactionHash"]: format_receipt(r) for r in receipts
+            if transaction_hashes is None or r["transactionHash"] in transaction_hashes}
+
+def get_receipts_batch(w3, transaction_hashes):
+    transaction_hashes = list(transaction_hashes)
+    receipts = rpc_batch(w3, [("eth_getTransactionReceipt", [h]) for h in transaction_hashes])
+    return {h: format_receipt(r) for h, r in zip(transaction_hashes, receipts) if not r is None}
+
+def get_receipts_single(w3, transaction_hashes):
+    return {h: format_receipt(w3.eth.get_transaction_receipt(h)) for h in transaction_hashes}
+
+def format_transaction(transaction):
+    transaction = {k: (_int(v) if k in INT_FIELDS else v) for k, v in transaction.items()}
+    transaction["hash"] = HexBytes(transaction["hash"])
+    transaction["from"] = Web3.to_checksum_address(transaction["from"])
+    if not transaction.get("to") is None:
+        transaction["to"] = Web3.to_checksum_address(transaction["to"])
+    return transaction
+
+def format_block(block):
+    # the fields process_block reads, in the same shape web3 returns them
+    return {"number": _int(block["number"]),
+            "hash": HexBytes(block["hash"]),
+            "miner": Web3.to_checksum_address(block["miner"]),
+            "baseFeePerGas": _int(block["baseFeePerGas"]),
+            "timestamp": _int(block["timestamp"]),
+            "logsBloom": HexBytes(block["logsBloom"]),
+            "transactions": [format_transaction(t) for t in block["transactions"]]}
+
+def _count(stats, name):
+    if not stats is None:
+        stats[name] = stats.get(name, 0) + 1
+
+def get_blocks_batch(w3, block_numbers, stats=None):
+    # a batch item that failed (rate limited, per item error) is fetched again on its own,
+    # a block still missing raises so the caller never skips it
+    block_numbers = list(block_numbers)
+    blocks = rpc_batch(w3, [("eth_getBlockByNumber", [hex(b), True]) for b in block_numbers])
+    output = {}
+    for b, block in zip(block_numbers, blocks):
+        if block is None:
+            _count(stats, "blocks_refetched")
+            print("block refetched", b)
+            block = rpc_request(w3, "eth_getBlockByNumber", [hex(b), True])
+            if block is None:
+                raise RPCError("block %d not found" % b)
+        output[b] = format_block(block)
+    return output
+
+def get_logs_range(w3, first_block, last_block, topics, address=None, window=None, stats=None):
+    # providers cap the size of a getLogs answer: a rejected span is halved, and after an accepted one the next span
+    # is sized so it holds about as many logs as the largest answer accepted so far,
+    # window {"span", "max_span", "max_logs"} carries this to the next range instead of starting from full size again
+    if window is None:
+        window = {}
+    logs = []
+    block = first_block
+    while block <= last_block:
+        span = max(1, min(window.get("span", last_block - first_block + 1), last_block - block + 1))
+        log_filter = {"fromBlock": hex(block), "toBlock": hex(block + span - 1), "topics": [list(topics)]}
+        if not address is None:
+            log_filter["address"] = address
+        _count(stats, "logs_calls")
+        try:
+            part = rpc_request(w3, "eth_getLogs", [log_filter])
+        except (RPCError, requests.exceptions.RequestException) as e:
+            if span == 1:
+                raise
+            _count(stats, "logs_rejected")
+            print("eth_getLogs split", block, block + span - 1, e)
+            window["span"] = span // 2
+            continue
+        logs.extend(format_log(l) for l in part)
+        block += span
+        window["max_logs"] = max(window.get("max_logs", 0), len(part))
+        span = max(1, span * window["max_logs"] // max(len(part), 1))
+        window["span"] = min(span, window.get("max_span", span))
+    return logs
+
+def _call_tracer_transfers(frame, transfers):
+    # value transfers below the top level call, reverted frames and everything under them are skipped
+    for call in frame.get("calls", []):
+        if "error" in call:
+            continue
+        value = _int(call.get("value", 0) or 0)
+        if value > 0 and call.get("type") in ["CALL", "CREATE", "CREATE2", "SELFDESTRUCT"]:
+            transfers.append((call["to"].lower(), value))
+        _call_tracer_transfers(call, transfers)
+
+def debug_trace_block_transfers(w3, block_number, transaction_hashes=None):
+    traces = rpc_request(w3, "debug_traceBlockByNumber", [hex(block_number), {"tracer": "callTracer"}])
+    block_transfers = {}
+    for i, trace in enumerate(traces):
+        # older nodes do not return txHash, the traces then follow the block transaction order
+        tx_hash = trace["txHash"] if "txHash" in trace else transaction_hashes[i]
+        transfers = []
+        if not "error" in trace["result"]:
+            _call_tracer_transfers(trace["result"], transfers)
+        block_transfers[tx_hash] = transfers
+    return block_transfers
+
+def trace_block_transfers(w3, block_number, transaction_hashes=None):
+    traces = rpc_request(w3, "trace_block", [hex(block_number)])
+    block_transfers = {}
+    reverted = set()
+    for trace in traces:
+        if trace["type"] == "reward" or trace.get("transactionHash") is None:
+            continue
+        tx_hash = trace["transactionHash"]
+        if not tx_hash in block_transfers:
+            block_transfers[tx_hash] = []
+        trace_address = tuple(trace["traceAddress"])
+        if "error" in trace:
+            reverted.add((tx_hash, trace_address))
+            continue
+        if len(trace_address) == 0 or any((tx_hash, trace_address[:i]) in reverted for i in range(len(trace_address))):
+            continue
+        action = trace["action"]
+        if trace["type"] == "suicide":
+            to, value = action["refundAddress"], _int(action["balance"])
+        elif trace["type"] == "create":
+            to, value = (trace.get("result") or {}).get("address"), _int(action["value"])
+        else:
+            to, value = action["to"], _int(action["value"])
+        if value > 0 and not to is None:
+            block_transfers[tx_hash].append((to.lower(), value))
+    return block_transfers
+
+def multicall(w3, calls, block_identifier="latest"):
+    # calls are (target, calldata), every call may fail on its own and returns None then
+    results = []
+    for i in range(0, len(calls), MULTICALL_BATCH):
+        chunk = [(Web3.to_checksum_address(target), True, calldata) for target, calldata in calls[i:i+MULTICALL_BATCH]]
+        res = w3.eth.call({"to": MULTICALL3, "data": AGGREGATE3_SELECTOR + encode(["(address,bool,bytes)[]"], [chunk])}, block_identifier)
+        results.extend(data if success else None for success, data in decode(["(bool,bytes)[]"], bytes(res))[0])
+    return results
+
+def decode_address(data):
+    if data is None or len(data) < 32:
+        return None
+    return "0x" + data[12:32].hex()
+
+def decode_uint(data):
+    if data is None or len(data) < 32:
+        return None
+    return int.from_bytes(data[:32], "big")
+
+def get_pools_tokens(w3, pools):
+    pools = list(pools)
+    results = multicall(w3, [c for p in pools for c in ((p, TOKEN0_SELECTOR), (p, TOKEN1_SELECTOR))])
+    pools_tokens = {}
+    for i, pool in enumerate(pools):
+        token0, token1 = decode_address(results[2*i]), decode_address(results[2*i+1])
+        if not token0 is None and not token1 is None:
+            pools_tokens[pool] = (token0, token1)
+    return pools_tokens
+
+def get_tokens_decimals(w3, tokens):
+    tokens = list(tokens)
+    results = multicall(w3, [(t, DECIMALS_SELECTOR) for t in tokens])
+    return {t: decode_uint(r) for t, r in zip(tokens, results)}
+
+def call_selector(w3, address, selector, block_identifier="latest"):
+    # a bare eth_call of an argument-less view function
+    return bytes(w3.eth.call({"to": Web3.to_checksum_address(address), "data": selector}, block_identifier))
+
+def get_pool_tokens(w3, pool):
+    token0 = decode_address(call_selector(w3, pool, TOKEN0_SELECTOR))
+    token1 = decode_address(call_selector(w3, pool, TOKEN1_SELECTOR))
+    if token0 is None or token1 is None:
+        raise ContractDataError("no token0/token1 in " + pool)
+    return token0, token1
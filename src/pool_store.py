@@ -0,0 +1,37 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+from caches import LRUCache
+
+class PoolStore(LRUCache):
+    # pool address -> (token0, token1), warm loaded from t_pools and t_pairs2 up to the cache size,
+    # new pools are kept aside and written back in one batch per flush
+    def __init__(self, max_items=None, stats=None):
+        LRUCache.__init__(self, "pools", max_items=max_items, stats=stats)
+        self.new_pools = {}
+
+    def load(self, db):
+        rows = [(r["pool"], r["token0"], r["token1"]) for r in db.get_pools()]
+        try:
+            rows = [(r["pair"], r["token0"], r["token1"]) for r in db.get_pairs()] + rows
+        except Exception as e:
+            print("t_pairs2 not loaded", repr(e))
+        for pool, token0, token1 in rows:
+            if not pool is None and not token0 is None and not token1 is None:
+                LRUCache.__setitem__(self, pool.lower(), (token0.lower(), token1.lower()))
+        print("pools loaded", len(self))
+
+    def get(self, address, default=None):
+        return LRUCache.get(self, address.lower(), default)
+
+    def __setitem__(self, address, tokens):
+        address = address.lower()
+        with self.lock:
+            LRUCache.__setitem__(self, address, tokens)
+            self.new_pools[address] = tokens
+
+    def flush(self, db):
+        with self.lock:
+            new_pools, self.new_pools = self.new_pools, {}
+        if len(new_pools):
+            db.add_pools([(p, new_pools[p][0], new_pools[p][1]) for p in new_pools])
@@ -2,18 +2,41 @@
 # -*- coding: utf-8 -*-
 
 import sys
+import time
 import os
 import json
+import asyncio
+import multiprocessing
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from functools import wraps
+from bisect import bisect_right
 import pandas as pd
 import numpy as np
 from web3 import Web3
+from web3.exceptions import ContractLogicError
 
 from price_monitor_db import DBMySQL
 from remote import RemoteServer
-from etherscan import get_contract_sync, etherscan_get_internals, etherscan_get_ethusd
+from etherscan import etherscan_get_internals, configure_client, MAX_INTERNALS
+from eth_price import EthPriceService
+from pool_store import PoolStore
+from token_store import TokenStore
+from caches import NegativeCache, LRUCache
+from event_decoder import decode_event
+from rate_graph import RateGraph
+from attack_rules import compile_rules, compile_attack_classes, classify_bundles
+from ema_engine import EMAEngine
+from bundle import Bundle, TokenTable, bundles_to_dicts, FIELDS as BUNDLE_FIELDS, TOKEN_FIELDS
+from node_rpc import RPCError, ContractDataError, is_unsupported_method, MAX_BATCH, get_block_receipts, get_receipts_batch, get_receipts_single, get_blocks_batch, get_logs_range, \
+    debug_trace_block_transfers, trace_block_transfers, get_pools_tokens, get_pool_tokens
+from new_heads import subscribe_new_heads
+from bloom import bloom_bits, bloom_contains_any, address_topic
 
 WETH = '0xc02aaa39b223fe8d0a0e5c4f27ead9083c756cc2'
+# a revert or an empty or undecodable answer, node errors (web3 raises ValueError with the json-rpc error)
+# and network failures are not the pool's fault
+BAD_POOL_ERRORS = (ContractLogicError, ContractDataError)
 
 PARAMETERS_FILE = "~/git/mev_price_monitor/parameters.json"
 KEY_FILE = '../keys/alchemy.sec'
@@ -31,6 +54,25 @@ with open(os.path.expanduser(parameters["ETHERSCAN_KEY_FILE"]), 'r') as f:
     k1 = f.readline()
     ETHERSCAN_KEY = k1.strip('\n')
 
+def configure_etherscan(share=1):
+    # the api limit is per key, worker processes get a share of it
+    configure_client(ETHERSCAN_KEY, rate=parameters.get("ETHERSCAN_RATE", 5) / share,
+                     cache_dir=parameters.get("ETHERSCAN_CACHE_DIR"))
+
+configure_etherscan()
+
+ETH_PRICES = None
+
+def get_eth_prices():
+    # one price service per process, the live price is refreshed in the background
+    global ETH_PRICES
+    if ETH_PRICES is None:
+        ETH_PRICES = EthPriceService(ETHERSCAN_KEY, parameters.get("ETH_PRICE_REFRESH", 60)).start()
+    return ETH_PRICES
+
+def preload_eth_prices(w3, first_block_number, db, historical=False):
+    return get_eth_prices().preload(db, w3.eth.get_block(first_block_number)["timestamp"], historical=historical)
+
 def provide_db(f):
     @wraps(f)
     def decorated(*args, **kwargs):
@@ -50,6 +92,7 @@ def create_tables():
         with DBMySQL(port=server.local_bind_port) as db:
             # db.create_tables(["t_blocks", "t_transactions", "t_events", "t_event_topics", "t_bundles"])
             db.create_tables(["t_attack_classes", "t_attack_events", "t_attacks", "t_attack_EMAs"])
+            # db.create_tables(["t_eth_prices", "t_pools", "t_bad_contracts"])
             # db.create_tables(["t_attack_EMAs", "t_attacks"])
             # db.create_tables(["t_attackers", "t_event_dict"])
 
@@ -63,186 +106,321 @@ def web3connect2(key_file):
     latest_block = w3.eth.get_block("latest")
     return w3, latest_block, {"alchemy_url": alchemy_url, "alchemy_wss": alchemy_wss}
 
+RECEIPTS_RETRIES = 3
+RECEIPTS_RETRY_DELAY = 0.5
 
-def process_block(block_number, run_context):
+def _retry_receipts(run_context, f, *args):
+    # a failed call is repeated in the same mode, an unsupported method is left to the caller to switch modes
+    for attempt in range(RECEIPTS_RETRIES):
+        try:
+            return f(*args)
+        except RPCError as e:
+            if is_unsupported_method(e) or attempt == RECEIPTS_RETRIES - 1:
+                raise
+            count_stats(run_context, "receipts_retries")
+            print("receipts call failed, retrying", e)
+            time.sleep(RECEIPTS_RETRY_DELAY * 2 ** attempt)
+
+def fetch_receipts(run_context, block_number, transaction_hashes):
+    # receipts_mode: "block" - eth_getBlockReceipts, "batch" - json-rpc batch, "single" - one call per transaction
+    if len(transaction_hashes) == 0:
+        return {}
     w3 = run_context["w3"]
-    block = w3.eth.get_block(block_number, full_transactions=True)
-
-    miner = block["miner"]
-    base_fee_per_gas = block["baseFeePerGas"]
-    block_hash = block["hash"].hex()
-
-    block_data = {"blockNumber": block_number,
-                  "baseFeePerGas": base_fee_per_gas,
-                  "blockHash": block_hash, 
-                  "miner": miner}    
-
-    if len(block["transactions"]) == 0:
-        return block_data, [], [], {}
-
-    _from_to_hashes = {}
-    for transaction in block["transactions"]:
+    receipts = None
+    if run_context["receipts_mode"] == "block":
+        try:
+            receipts = _retry_receipts(run_context, get_block_receipts, w3, block_number, transaction_hashes)
+        except RPCError as e:
+            if not is_unsupported_method(e):
+                raise
+            print("eth_getBlockReceipts is not available, switching to batch receipts", e)
+            run_context["receipts_mode"] = "batch"
+    if run_context["receipts_mode"] == "batch":
+        try:
+            receipts = _retry_receipts(run_context, get_receipts_batch, w3, transaction_hashes)
+        except RPCError as e:
+            if not is_unsupported_method(e):
+                raise
+            print("batch receipts are not available, switching to single receipts", e)
+            run_context["receipts_mode"] = "single"
+    if receipts is None:
+        receipts = {}
+    missing_hashes = [h for h in transaction_hashes if not h in receipts]
+    if len(missing_hashes):
+        receipts.update(get_receipts_single(w3, missing_hashes))
+    return receipts
+
+def group_block_transactions(transactions, run_context):
+    # positions of transactions per (from, to), multisender attackers are grouped by to only
+    multisender_attackers = set(run_context["multisender_attackers"])
+    attaker_status = run_context["attaker_status"]
+    groups = {}
+    for ti, transaction in enumerate(transactions):
         if "to" in transaction and not transaction["to"] is None:
-            if transaction["to"] in run_context["multisender_attackers"]:
-                transaction_from = None
+            if transaction["to"] in multisender_attackers:
+                from_to = (None, transaction["to"])
             else:
-                transaction_from = transaction["from"]
-            
-            if (transaction_from, transaction["to"]) in run_context["attaker_status"] and run_context["attaker_status"][(transaction_from, transaction["to"])] == -1:
+                from_to = (transaction["from"], transaction["to"])
+            if attaker_status.get(from_to) == -1 or attaker_status.get((None, transaction["to"])) == -1:
                 continue
-            if (None, transaction["to"]) in run_context["attaker_status"] and run_context["attaker_status"][(None, transaction["to"])] == -1:
-                continue
-            if not (transaction_from, transaction["to"]) in _from_to_hashes:
-                _from_to_hashes[(transaction_from, transaction["to"])] = {"count": 1,
-                                                                            "tx_counter": 0,
-                                                                            "min_index": transaction["transactionIndex"],
-                                                                            "max_index": transaction["transactionIndex"]}
+            if from_to in groups:
+                groups[from_to].append(ti)
             else:
-                _from_to_hashes[(transaction_from, transaction["to"])]["count"] += 1
-                _from_to_hashes[(transaction_from, transaction["to"])]["min_index"] = min(_from_to_hashes[(transaction_from, transaction["to"])]["min_index"],
-                                                                                            transaction["transactionIndex"])
-                _from_to_hashes[(transaction_from, transaction["to"])]["max_index"] = max(_from_to_hashes[(transaction_from, transaction["to"])]["max_index"],
-                                                                                            transaction["transactionIndex"])
-    from_to_hashes = {f: _from_to_hashes[f] for f in _from_to_hashes if _from_to_hashes[f]["count"] > 1}
+                groups[from_to] = [ti]
+    return {f: groups[f] for f in groups if len(groups[f]) > 1}
+
+def count_stats(run_context, name, n=1):
+    run_context["stats"][name] = run_context["stats"].get(name, 0) + n
+
+def transaction_prefix_counts(transactions):
+    prefix_counts = [0]
+    for transaction in transactions:
+        prefix_counts.append(prefix_counts[-1] + ("to" in transaction))
+    return prefix_counts
+
+def prescreen_groups(groups, prefix_counts):
+    # a group can be a bundle only if other transactions are interleaved between its first and last one,
+    # decided from the ordering alone before any receipt is fetched
+    return {f: groups[f] for f in groups
+            if prefix_counts[groups[f][-1]+1] - prefix_counts[groups[f][0]+1] - (len(groups[f]) - 1) > 0}
+
+def prune_groups_by_bloom(groups, block):
+    # logsBloom has no false negatives: a block without any processed topic cannot have bundles,
+    # and a bot contract that neither emitted a log nor shows up as an indexed address moved no tokens
+    if len(groups) == 0 or not "logsBloom" in block:
+        return groups
+    bloom = bytes(block["logsBloom"])
+    if not bloom_contains_any(bloom, TOPICS_BLOOM_BITS):
+        return {}
+    return {f: groups[f] for f in groups
+            if bloom_contains_any(bloom, [bloom_bits(f[1]), bloom_bits(address_topic(f[1]))])}
+
+def set_transaction_gas(transaction, receipt, base_fee_per_gas):
+    transaction["gasUsed"] = receipt["gasUsed"]
+    transaction["gasBurnt"] = base_fee_per_gas * receipt["gasUsed"]
+    transaction["gasOverpay"] = (receipt["effectiveGasPrice"] - base_fee_per_gas) * receipt["gasUsed"]
+
+def receipts_from_logs(block_logs, transaction_hashes):
+    # stand-ins for receipts when the logs come from a range eth_getLogs scan: a transaction without logs is taken
+    # as failed, the gas is unknown until the real receipts of the bundle transactions are fetched
+    receipts = {h: {"status": 0, "gasUsed": None, "effectiveGasPrice": None, "logs": []} for h in transaction_hashes}
+    for log in block_logs:
+        if log["transactionHash"] in receipts:
+            receipts[log["transactionHash"]]["status"] = 1
+            receipts[log["transactionHash"]]["logs"].append(log)
+    return receipts
+
+def collect_bundle_transactions(block_number, block, groups, receipts, prefix_counts):
+    # one pass over the group positions, inner transactions are counted with prefix sums over the block
+    base_fee_per_gas = block["baseFeePerGas"]
 
     block_transactions = []
     block_events = []
-    block_attakers = {}
-
-    for from_to in from_to_hashes:
+    from_to_hashes = {}
+    for from_to in groups:
+        positions = groups[from_to]
+        from_to_transactions = []
         from_to_events = []
-        block_attakers[from_to] = {"status": 1}
         min_index = None
         max_index = None
-        for ti in range(from_to_hashes[from_to]["min_index"], from_to_hashes[from_to]["max_index"]+1):
+        for ti in positions:
             transaction = block["transactions"][ti]
-            if (transaction["from"] != from_to[0] and not from_to[0] is None) or transaction["to"] != from_to[1]:
-                continue
-            transaction_hash = transaction["hash"].hex()
             if transaction["transactionIndex"] != ti:
                 print("something wrong with transaction index", block_number, ti, transaction["transactionIndex"])
                 break
-            if not transaction_hash in block_transactions:
-                receipt = w3.eth.get_transaction_receipt(transaction_hash)
-                if receipt["status"] != 1:
-                    continue
-
-                for e in receipt["logs"]:
-                    e = dict(e)
-                    e["transactionHash"] = e["transactionHash"].hex()
-                    e["data"] = e["data"].hex()
-                    e["topics"] = [bt.hex() for bt in e["topics"]]
-
-                    # if not e["topics"][0] in run_context["topic_filter"]:
-                    #     if not e["topics"][0] in run_context["unknown_topics"]:
-                    #         run_context["unknown_topics"][e["topics"][0]] = transaction_hash
-                    #     # print("unknown topic in sandwich-like transactions", transaction_hash, e["topics"][0])
-                    #     tx_logs.append(e)
-                    # elif not run_context["topic_filter"][e["topics"][0]]["note"] is None:
-                    #     tx_logs.append(e)
-                    # elif (e["topics"][0] == "0xddf252ad1be2c89b69c2b068fc378daa952ba7f163c4a11628f55a4df523b3ef" and len(e["topics"]) > 2 and
-                    #       (e["topics"][1] == "0x0000000000000000000000000000000000000000000000000000000000000000" or 
-                    #       e["topics"][2] == "0x0000000000000000000000000000000000000000000000000000000000000000")):
-                    #     tx_logs.append(e) #!!! special case: Tranfer as NFT mint/burn
-                    # elif (e["topics"][0] == "0xddf252ad1be2c89b69c2b068fc378daa952ba7f163c4a11628f55a4df523b3ef" and len(e["topics"]) > 1 and
-                    #       e["topics"][2][-40:] == e["address"][-40:].lower()):
-                    #     tx_logs.append(e) #!!! special case: Tranfer tax
-                    from_to_events.append(e)
-    
-                if max_index is None or max_index < ti:
-                    max_index = ti
-                if min_index is None or min_index > ti:
-                    min_index = ti
-                block_transactions.append({
-                    "hash": transaction_hash,
-                    "blockNumber": block_number,
-                    "fromTx": transaction["from"],
-                    "toTx": transaction["to"],
-                    "transactionIndex": transaction["transactionIndex"],
-                    "gasUsed": receipt["gasUsed"],
-                    "gasPrice": transaction["gasPrice"],
-                    "maxFeePerGas": (transaction["maxFeePerGas"] if "maxFeePerGas" in transaction else None),
-                    "maxPriorityFeePerGas": (transaction["maxPriorityFeePerGas"] if "maxPriorityFeePerGas" in transaction else None),
-                    "gasBurnt": base_fee_per_gas * receipt["gasUsed"],
-                    "gasOverpay": (receipt["effectiveGasPrice"] - base_fee_per_gas) * receipt["gasUsed"],
-                    # "directBribe": ,
-                    "value": transaction["value"],
-                    "role": 1,
-                    })
- 
-        from_to_hashes[from_to]["min_index"] = min_index
-        from_to_hashes[from_to]["max_index"] = max_index
-        if len(from_to_events) == 0:
-            block_attakers[from_to] = {"status": 0}
-        else:
-            block_events.extend(from_to_events)
-
-
-    for from_to in from_to_hashes:
-        if block_attakers[from_to]["status"] == 0:
-            continue
-        for transaction in block["transactions"][from_to_hashes[from_to]["min_index"]+1:from_to_hashes[from_to]["max_index"]+1]:
-            if (transaction["from"] == from_to[0] or from_to[0] is None) and transaction["to"] == from_to[1]:
+            transaction_hash = transaction["hash"].hex()
+            receipt = receipts[transaction_hash]
+            if receipt["status"] != 1:
                 continue
-            if "to" in transaction:
-                from_to_hashes[from_to]["tx_counter"] += 1
-                
-    hashes_to_delete = []
-    for from_to in from_to_hashes:
-        if not from_to_hashes[from_to]["tx_counter"]:
-            block_attakers[from_to] = {"status": 0}
-            for t in block_transactions:
-                if (t["fromTx"] == from_to[0] or from_to[0] is None) and t["toTx"] == from_to[1]:
-                    hashes_to_delete.append(t["hash"])
 
-    block_transactions = [t for t in block_transactions if not t["hash"] in hashes_to_delete]
-    block_events = [e for e in block_events if not e["transactionHash"] in hashes_to_delete]
-    
-    if len([1 for a in block_attakers if block_attakers[a]["status"] == 1]):
-        internal_transactions = etherscan_get_internals(etherscan_key=run_context["etherscan_key"],
-                                                        block_number=block_number, address=miner)
-        if not internal_transactions is None:
-            for itx in internal_transactions:
-                if itx["to"] == miner.lower():
-                    for t in block_transactions:
-                        if itx["hash"] == t["hash"]:
-                            t["directBribe"] = int(itx["value"])
+            for e in receipt["logs"]:
+                e = dict(e)
+
+                # if not e["topics"][0] in run_context["topic_filter"]:
+                #     if not e["topics"][0] in run_context["unknown_topics"]:
+                #         run_context["unknown_topics"][e["topics"][0]] = transaction_hash
+                #     # print("unknown topic in sandwich-like transactions", transaction_hash, e["topics"][0])
+                #     tx_logs.append(e)
+                # elif not run_context["topic_filter"][e["topics"][0]]["note"] is None:
+                #     tx_logs.append(e)
+                # elif (e["topics"][0] == "0xddf252ad1be2c89b69c2b068fc378daa952ba7f163c4a11628f55a4df523b3ef" and len(e["topics"]) > 2 and
+                #       (e["topics"][1] == "0x0000000000000000000000000000000000000000000000000000000000000000" or 
+                #       e["topics"][2] == "0x0000000000000000000000000000000000000000000000000000000000000000")):
+                #     tx_logs.append(e) #!!! special case: Tranfer as NFT mint/burn
+                # elif (e["topics"][0] == "0xddf252ad1be2c89b69c2b068fc378daa952ba7f163c4a11628f55a4df523b3ef" and len(e["topics"]) > 1 and
+                #       e["topics"][2][-40:] == e["address"][-40:].lower()):
+                #     tx_logs.append(e) #!!! special case: Tranfer tax
+                from_to_events.append(e)
+
+            if max_index is None:
+                min_index = ti
+            max_index = ti
+            from_to_transactions.append({
+                "hash": transaction_hash,
+                "blockNumber": block_number,
+                "fromTx": transaction["from"],
+                "toTx": transaction["to"],
+                "transactionIndex": transaction["transactionIndex"],
+                "gasPrice": transaction["gasPrice"],
+                "maxFeePerGas": (transaction["maxFeePerGas"] if "maxFeePerGas" in transaction else None),
+                "maxPriorityFeePerGas": (transaction["maxPriorityFeePerGas"] if "maxPriorityFeePerGas" in transaction else None),
+                # "directBribe": ,
+                "value": transaction["value"],
+                "role": 1,
+                })
+            if not receipt["gasUsed"] is None:
+                set_transaction_gas(from_to_transactions[-1], receipt, base_fee_per_gas)
 
+        if len(from_to_events) == 0:
+            continue
+        tx_counter = (prefix_counts[max_index+1] - prefix_counts[min_index+1] -
+                      (bisect_right(positions, max_index) - bisect_right(positions, min_index)))
+        if tx_counter == 0:
+            continue
+        from_to_hashes[from_to] = {"tx_counter": tx_counter,
+                                   "min_index": min_index,
+                                   "max_index": max_index}
+        block_transactions.extend(from_to_transactions)
+        block_events.extend(from_to_events)
+    return block_transactions, block_events, from_to_hashes
+
+def make_block_bundles(block_number, block_transactions, from_to_hashes):
     block_bundles = {(block_number, from_to[0], from_to[1]):
-                     {"transactions": [],
-                      "a_innerTxNumber": from_to_hashes[from_to]["tx_counter"],
-                      "directBribe": 0,
-                      "gasBurnt": 0,
-                      "gasOverpay": 0,
-                      "min_index": from_to_hashes[from_to]["min_index"],
-                      "max_index": from_to_hashes[from_to]["max_index"]}
-                     for from_to in from_to_hashes if from_to_hashes[from_to]["tx_counter"] > 0}
+                     Bundle(transactions=[],
+                            a_innerTxNumber=from_to_hashes[from_to]["tx_counter"],
+                            directBribe=0,
+                            gasBurnt=0,
+                            gasOverpay=0,
+                            min_index=from_to_hashes[from_to]["min_index"],
+                            max_index=from_to_hashes[from_to]["max_index"])
+                     for from_to in from_to_hashes}
 
     for t in block_transactions:
         if (block_number, t["fromTx"], t["toTx"]) in block_bundles:
-            if (from_to_hashes[(t["fromTx"], t["toTx"])]["min_index"] <= t["transactionIndex"] and
-                from_to_hashes[(t["fromTx"], t["toTx"])]["max_index"] >= t["transactionIndex"]):
-                block_bundles[(block_number, t["fromTx"], t["toTx"])]["transactions"].append(t)
-                block_bundles[(block_number, t["fromTx"], t["toTx"])]["directBribe"] += (t["directBribe"] if "directBribe" in t else 0)
-                block_bundles[(block_number, t["fromTx"], t["toTx"])]["gasBurnt"] += (t["gasBurnt"] if "gasBurnt" in t else 0)
-                block_bundles[(block_number, t["fromTx"], t["toTx"])]["gasOverpay"] += (t["gasOverpay"] if "gasOverpay" in t else 0)
-        elif (block_number, None, t["toTx"]) in block_bundles:
-            if (from_to_hashes[(None, t["toTx"])]["min_index"] <= t["transactionIndex"] and
-                from_to_hashes[(None, t["toTx"])]["max_index"] >= t["transactionIndex"]):
-                block_bundles[(block_number, None, t["toTx"])]["transactions"].append(t)
-                block_bundles[(block_number, None, t["toTx"])]["directBribe"] += (t["directBribe"] if "directBribe" in t else 0)
-                block_bundles[(block_number, None, t["toTx"])]["gasBurnt"] += (t["gasBurnt"] if "gasBurnt" in t else 0)
-                block_bundles[(block_number, None, t["toTx"])]["gasOverpay"] += (t["gasOverpay"] if "gasOverpay" in t else 0)
+            bundle = block_bundles[(block_number, t["fromTx"], t["toTx"])]
+        else:
+            bundle = block_bundles[(block_number, None, t["toTx"])]
+        bundle.transactions.append(t)
+        bundle.directBribe += (t["directBribe"] if "directBribe" in t else 0)
+        bundle.gasBurnt += t["gasBurnt"]
+        bundle.gasOverpay += t["gasOverpay"]
+
+    for bundle in block_bundles.values():
+        bundle.directBribe = bundle.directBribe / 1e18
+        bundle.gasBurnt = bundle.gasBurnt / 1e18
+        bundle.gasOverpay = bundle.gasOverpay / 1e18
+    return block_bundles
+
+BRIBE_TRACERS = {"debug_trace": debug_trace_block_transfers,
+                 "trace_block": trace_block_transfers}
+
+def get_direct_bribes(run_context, block_number, miner, block=None):
+    # BRIBE_SOURCE: "etherscan", or "debug_trace" / "trace_block" on our own node with etherscan as the fallback
+    bribe_source = run_context.get("bribe_source", parameters.get("BRIBE_SOURCE", "etherscan"))
+    if bribe_source in BRIBE_TRACERS:
+        try:
+            return get_direct_bribes_traced(run_context, block_number, miner, bribe_source, block)
+        except Exception as e:
+            print("trace error, falling back to etherscan", block_number, repr(e))
+            count_stats(run_context, "bribe_trace_errors")
+            if isinstance(e, RPCError) and is_unsupported_method(e):
+                # the node has no such trace method, it is not asked again
+                run_context["bribe_source"] = "etherscan"
+    return get_direct_bribes_etherscan(run_context, block_number, miner)
+
+def get_direct_bribes_traced(run_context, block_number, miner, bribe_source, block=None):
+    transaction_hashes = None if block is None else [t["hash"].hex() for t in block["transactions"]]
+    block_transfers = BRIBE_TRACERS[bribe_source](run_context["w3"], block_number, transaction_hashes)
+    miner = miner.lower()
+    direct_bribes = {}
+    for tx_hash in block_transfers:
+        value = sum(v for to, v in block_transfers[tx_hash] if to == miner)
+        if value > 0:
+            direct_bribes[tx_hash] = value
+    return direct_bribes
+
+def get_direct_bribes_etherscan(run_context, block_number, miner):
+    # internal transfers to the builder are fetched for a window of blocks per builder address
+    # and resolved locally by (block, hash) until the window is left
+    miner = miner.lower()
+    window = run_context["bribes_cache"].get(miner)
+    if window is None or not window["start"] <= block_number <= window["end"]:
+        end_block = max(block_number, min(block_number + parameters.get("BRIBE_BLOCK_WINDOW", 300) - 1,
+                                          run_context.get("last_block_number", block_number)))
+        # ranges deeper than REORG_DEPTH below the chain head are final and go to the disk cache,
+        # the head and not the last block of the run, which in a backfill is only the end of the shard
+        head_block_number = run_context.get("head_block_number", run_context.get("last_block_number", 0))
+        cache = end_block + parameters.get("REORG_DEPTH", 64) <= head_block_number
+        internal_transactions = etherscan_get_internals(etherscan_key=run_context["etherscan_key"],
+                                                        block_number=block_number, address=miner, end_block=end_block, cache=cache)
+        if not isinstance(internal_transactions, list):
+            return None
+        if len(internal_transactions) >= MAX_INTERNALS:
+            # the answer is truncated, only blocks before the last returned one are complete
+            end_block = int(internal_transactions[-1]["blockNumber"]) - 1
+            if end_block < block_number:
+                end_block = block_number
+                internal_transactions = etherscan_get_internals(etherscan_key=run_context["etherscan_key"],
+                                                                block_number=block_number, address=miner, cache=cache)
+                if not isinstance(internal_transactions, list):
+                    return None
+        window = {"start": block_number, "end": end_block, "bribes": {}}
+        for itx in internal_transactions:
+            itx_block_number = int(itx["blockNumber"])
+            if itx["to"] == miner and itx_block_number <= end_block:
+                if not itx_block_number in window["bribes"]:
+                    window["bribes"][itx_block_number] = {}
+                window["bribes"][itx_block_number][itx["hash"]] = int(itx["value"])
+        run_context["bribes_cache"][miner] = window
+        count_stats(run_context, "etherscan_internals_calls")
+    return window["bribes"].get(block_number, {})
+
+def process_block(block_number, run_context, block=None, block_logs=None):
+    w3 = run_context["w3"]
+    if block is None:
+        block = w3.eth.get_block(block_number, full_transactions=True)
 
-    for b in block_bundles:
-        block_bundles[b]["directBribe"] = block_bundles[b]["directBribe"] / 1e18
-        block_bundles[b]["gasBurnt"] = block_bundles[b]["gasBurnt"] / 1e18
-        block_bundles[b]["gasOverpay"] = block_bundles[b]["gasOverpay"] / 1e18
+    miner = block["miner"]
+    base_fee_per_gas = block["baseFeePerGas"]
+    block_hash = block["hash"].hex()
 
     block_data = {"blockNumber": block_number,
                   "baseFeePerGas": base_fee_per_gas,
                   "blockHash": block_hash, 
-                  "miner": miner}
+                  "miner": miner,
+                  "timestamp": block["timestamp"]}
+
+    if len(block["transactions"]) == 0:
+        return block_data, [], [], {}
+
+    groups = group_block_transactions(block["transactions"], run_context)
+    prefix_counts = transaction_prefix_counts(block["transactions"])
+    prescreened_groups = prescreen_groups(groups, prefix_counts)
+    candidate_groups = prune_groups_by_bloom(prescreened_groups, block)
+    transaction_hashes = {block["transactions"][ti]["hash"].hex() for from_to in candidate_groups for ti in candidate_groups[from_to]}
+    count_stats(run_context, "receipts_needed", len(transaction_hashes))
+    count_stats(run_context, "receipts_skipped_prescreen", sum(len(groups[f]) for f in groups if not f in prescreened_groups))
+    count_stats(run_context, "receipts_skipped_bloom", sum(len(prescreened_groups[f]) for f in prescreened_groups if not f in candidate_groups))
+    if block_logs is None:
+        receipts = fetch_receipts(run_context, block_number, transaction_hashes)
+    else:
+        receipts = receipts_from_logs(block_logs, transaction_hashes)
+
+    block_transactions, block_events, from_to_hashes = collect_bundle_transactions(block_number, block, candidate_groups,
+                                                                                   receipts, prefix_counts)
+    if not block_logs is None:
+        receipts = fetch_receipts(run_context, block_number, {t["hash"] for t in block_transactions})
+        for t in block_transactions:
+            set_transaction_gas(t, receipts[t["hash"]], base_fee_per_gas)
+
+    if len(from_to_hashes):
+        direct_bribes = get_direct_bribes(run_context, block_number, miner, block)
+        if not direct_bribes is None:
+            for t in block_transactions:
+                if t["hash"] in direct_bribes:
+                    t["directBribe"] = direct_bribes[t["hash"]]
+
+    block_bundles = make_block_bundles(block_number, block_transactions, from_to_hashes)
 
     return block_data, block_transactions, block_events, block_bundles
 
@@ -257,9 +435,7 @@ def write_block_transactions(block_data, block_transactions, block_events, block
 
 @provide_db
 def update_bundles(block_bundles, db):
-    with RemoteServer(remote=REMOTE) as server:
-        with DBMySQL(port=server.local_bind_port) as db:
-            db.update_bundles(block_bundles)
+    db.update_bundles(block_bundles)
 
 @provide_db
 def get_block_data(block_number, db):
@@ -282,17 +458,17 @@ def get_block_data(block_number, db):
 
 @provide_db
 def clean_block_data(block_number, db):
-    with RemoteServer(remote=REMOTE) as server:
-        with DBMySQL(port=server.local_bind_port) as db:
-            db.clean_block_data(block_number)
+    db.clean_block_data(block_number)
 
 
 STABLECOINS = {"0xA0b86991c6218b36c1d19D4a2e9Eb0cE3606eB48".lower(): "USD Coin",
                "0xdAC17F958D2ee523a2206206994597C13D831ec7".lower(): "Tether USD",
                "0x6B175474E89094C44Da98b954EedeAC495271d0F".lower(): "Dai"}
-_COIN_DECIMALS = {"0xA0b86991c6218b36c1d19D4a2e9Eb0cE3606eB48".lower(): 1e6,
-                 "0xdAC17F958D2ee523a2206206994597C13D831ec7".lower(): 1e6,
-                 "0x2260fac5e5542a773aa44fbcfedf7c193bc2c599".lower(): 1e8}
+# one registry per process, filled from t_tokens2 and on chain, coin_decimals reads its dict directly
+TOKEN_STORE = TokenStore({"0xA0b86991c6218b36c1d19D4a2e9Eb0cE3606eB48".lower(): 1e6,
+                          "0xdAC17F958D2ee523a2206206994597C13D831ec7".lower(): 1e6,
+                          "0x2260fac5e5542a773aa44fbcfedf7c193bc2c599".lower(): 1e8})
+_COIN_DECIMALS = TOKEN_STORE.scales
 TOPICS_TO_PROCESS = {
     "0x7fcf532c15f0a6db0bd6d0e038bea71d30d808c7d98cb3bf7268a95bf5081b65": "withdraw",
     "0xe1fffcc4923d04b559f4d29a8bfc6cda04eb5b0d3c460751c2402c5c5cc9109c": "deposit",
@@ -303,148 +479,88 @@ TOPICS_TO_PROCESS = {
     "0x70935338e69775456a85ddef226c395fb668b63fa0115f5f20610b388e6ca9c0": "collect",
     "0xddf252ad1be2c89b69c2b068fc378daa952ba7f163c4a11628f55a4df523b3ef": "transfer",
     }
+TOPICS_BLOOM_BITS = [bloom_bits(t) for t in TOPICS_TO_PROCESS]
+POOL_EVENTS = ["a_uniswapV2", "a_uniswapV3", "a_pancakeV3", "mint", "collect"]
 
 def coin_decimals(token):
-    return (_COIN_DECIMALS[token] if token in _COIN_DECIMALS else 1e18)
+    return _COIN_DECIMALS.get(token, 1e18)
 
 def make_properties(event, trnx, bundle, token0=None, token1=None):
-    if "saldo" in bundle and not bundle["saldo"] is None:
-        if not "txs" in bundle or bundle["txs"] is None:
-            bundle["txs"] = set()
+    if not bundle.saldo_values is None:
+        if getattr(bundle, "txs", None) is None:
+            bundle.txs = set()
         return
     if not event in TOPICS_TO_PROCESS:
         return
     if (TOPICS_TO_PROCESS[event] in ["withdraw", "deposit", "transfer"]):
-        bundle["saldo"] = {"eth": 0}
-        bundle["capitalRequirements"] = {"eth": 0}
+        bundle.start(bundle.table, ["eth"])
     elif TOPICS_TO_PROCESS[event] in ["a_uniswapV2", "a_uniswapV3", "mint", "collect", "a_pancakeV3"]:
-        bundle["saldo"] = {token0: 0, token1: 0, "eth": 0}
-        bundle["capitalRequirements"] = {token0: 0, token1: 0, "eth": 0}
-    bundle["rates"] = {}
-    bundle["directBribe"] = 0
-    bundle["gasBurnt"] = 0
-    bundle["gasOverpay"] = 0
-    bundle["txs"] = set()
-    bundle["a_mintBurnV3"] = 0
-    bundle["a_mintBurnNFT"] = 0
-    bundle["a_uniswapV2"] = 0
-    bundle["a_uniswapV3"] = 0
-    bundle["a_pancakeV3"] = 0
+        bundle.start(bundle.table, [token0, token1, "eth"])
     
-def add_tokens(bundle, *tokens):
-    for token in tokens:
-        if not token in bundle["saldo"]:
-            bundle["saldo"][token] = 0 
-            bundle["capitalRequirements"][token] = 0 
-            
-def change_capital(bundle, *tokens):
-    for token in tokens:
-        if bundle["saldo"][token] < -bundle["capitalRequirements"][token]:
-            bundle["capitalRequirements"][token] = -bundle["saldo"][token]
-
 def update_rates(bundle, token0, token1, r1, r2):
     if r1 == 0 or r2 == 0:
         return
-    bundle["rates"][(token0, token1)] = abs(r1 * coin_decimals(token0) / r2 / coin_decimals(token1))
+    bundle.rates[(token0, token1)] = abs(r1 * coin_decimals(token0) / r2 / coin_decimals(token1))
 
-def get_two_tokensV2(run_context, address):
-    if not address in run_context["pairs_VXXX"]:
-        try:
-            contract, _ = get_contract_sync(address, w3=run_context["w3"], context=run_context, abi_type="pair")
-            token0 = contract.functions.token0().call().lower()
-            token1 = contract.functions.token1().call().lower()
-        except:
+def get_two_tokens(run_context, address):
+    tokens = run_context["pairs_VXXX"].get(address)
+    if tokens is None:
+        if address in run_context["bad_pools"]:
             return (None, None)
-        run_context["pairs_VXXX"][address] = (token0, token1)
-    return run_context["pairs_VXXX"][address]
-
-def get_two_tokensV3(run_context, address):
-    if not address in run_context["pairs_VXXX"]:
         try:
-            contract, _ = get_contract_sync(address, w3=run_context["w3"], context=run_context, abi_type="pool")
-            token0 = contract.functions.token0().call().lower()
-            token1 = contract.functions.token1().call().lower()
-        except:
+            tokens = get_pool_tokens(run_context["w3"], address)
+        except BAD_POOL_ERRORS as e:
+            run_context["bad_pools"].add(address, repr(e))
             return (None, None)
-        run_context["pairs_VXXX"][address] = (token0, token1)
-    return run_context["pairs_VXXX"][address]
-
-def get_two_tokens_other(run_context, address):
-    if not address in run_context["pairs_VXXX"]:
-        try:
-            contract, _ = get_contract_sync(address, w3=run_context["w3"], context=run_context)
-            token0 = contract.functions.token0().call().lower()
-            token1 = contract.functions.token1().call().lower()
-        except:
+        except Exception as e:
+            # retried with the pool's next event
+            count_stats(run_context, "pool_transient_errors")
+            print("pool tokens not read", address, repr(e))
             return (None, None)
-        run_context["pairs_VXXX"][address] = (token0, token1)
-    return run_context["pairs_VXXX"][address]
-
-def update_gas(transaction, bundle):
-    if not transaction["hash"] in bundle["txs"]:
-        bundle["txs"].add(transaction["hash"])
-        bundle["gasBurnt"] += int(transaction["gasBurnt"])/1e18
-        bundle["saldo"]["eth"] -= int(transaction["gasBurnt"])/1e18
-        bundle["gasOverpay"] += int(transaction["gasOverpay"])/1e18
-        bundle["saldo"]["eth"] -= int(transaction["gasOverpay"])/1e18
-        if "directBribe" in transaction:
-            bundle["directBribe"] += int(transaction["directBribe"])/1e18
-            bundle["saldo"]["eth"] -= int(transaction["directBribe"])/1e18
-        if bundle["saldo"]["eth"] < -bundle["capitalRequirements"]["eth"]:
-            bundle["capitalRequirements"]["eth"] = -bundle["saldo"]["eth"]
-
-def revert_rate(tokenA, pair, rate):
-    if tokenA == pair[0]:
-        return rate
-    else:
-        if rate == 0:
-            return 1e100
-        else:
-            return 1/rate
-
-def find_rate(tokenA, tokenB, rates):
-    # number of tokens B for 1 token A
-    # two step max
-    if tokenA == tokenB:
-        return 1
-    pair = (min(tokenA, tokenB), max(tokenA, tokenB))
-    if pair in rates:
-        return revert_rate(tokenA, pair, rates[pair])
-    if tokenA in STABLECOINS and tokenB in STABLECOINS:
-        return 1
-    if tokenA in STABLECOINS:
-        for tokenS in STABLECOINS:
-            if tokenS != tokenA:
-                pair1 = (min(tokenS, tokenB), max(tokenS, tokenB))
-                if pair1 in rates:
-                    return revert_rate(tokenS, pair1, rates[pair1])
-    if tokenB in STABLECOINS:
-        for tokenS in STABLECOINS:
-            if tokenS != tokenB:
-                pair1 = (min(tokenS, tokenA), max(tokenS, tokenA))
-                if pair1 in rates:
-                    return revert_rate(tokenA, pair1, rates[pair1])
-    for p in rates:
-        if tokenA in p and not tokenB in p:
-            if tokenA == p[0]:
-                pair1 = (min(p[1], tokenB), max(p[1], tokenB))
-            else:
-                pair1 = (min(p[0], tokenB), max(p[0], tokenB))
-            if pair1 in rates:
-                return revert_rate(tokenA, p, rates[p]) / revert_rate(tokenB, pair1, rates[pair1])
-                # return rates[pair]
-        elif tokenB in p and not tokenA in p:
-            if tokenB == p[0]:
-                pair1 = (min(p[1], tokenA), max(p[1], tokenA))
+        run_context["pairs_VXXX"][address] = tokens
+    return tokens
+
+def prefetch_pools(run_context, events):
+    # token0/token1 of the pools unknown so far and decimals of the block's tokens never seen before
+    # are resolved with two multicalls, what fails here is left to get_two_tokens
+    pools = set(e["address"] for e in events if TOPICS_TO_PROCESS.get(e["topics"][0]) in POOL_EVENTS)
+    transfer_tokens = set(e["address"].lower() for e in events if TOPICS_TO_PROCESS.get(e["topics"][0]) == "transfer")
+    pools_tokens = {p: run_context["pairs_VXXX"].get(p) for p in pools}
+    new_pools = [p for p in pools if pools_tokens[p] is None and not p in run_context["bad_pools"]]
+    try:
+        if len(new_pools):
+            pools_tokens.update(get_pools_tokens(run_context["w3"], new_pools))
+            for pool in new_pools:
+                if not pools_tokens[pool] is None:
+                    run_context["pairs_VXXX"][pool] = pools_tokens[pool]
+            count_stats(run_context, "multicall_pools", len(new_pools))
+        tokens = set(t for p in pools if not pools_tokens[p] is None for t in pools_tokens[p]) | transfer_tokens
+        count_stats(run_context, "multicall_decimals", run_context["tokens"].resolve(run_context["w3"], tokens))
+    except Exception as e:
+        print("multicall error", repr(e))
+
+def index_transactions(transactions, run_context):
+    # hash -> (transaction, (from, to) of its bundle), the first transaction with a hash wins
+    transactions_index = {}
+    for transaction in transactions:
+        if not transaction["hash"] in transactions_index:
+            if transaction["toTx"] in run_context["multisender_attackers"]:
+                transaction_from = None
             else:
-                pair1 = (min(p[0], tokenA), max(p[0], tokenA))
-            if pair1 in rates:
-                return revert_rate(tokenA, pair1, rates[pair1]) / revert_rate(tokenB, p, rates[p])
-                # return rates[pair]
-    return None
-
-def process_bundles(run_context, events, transactions, bundles):
-    fixed_weth_rate = run_context["eth_rate"] #!!!
+                transaction_from = transaction["fromTx"]
+            transactions_index[transaction["hash"]] = (transaction, (transaction_from, transaction["toTx"]))
+    return transactions_index
+
+# a bundle loaded from t_bundles is recomputed from its events, only the fields make_block_bundles sets are kept
+RECOMPUTED_FIELDS = set(BUNDLE_FIELDS[7:]) - {"bundleId"} | set(TOKEN_FIELDS) | {"features"}
+
+def process_bundles(run_context, events, transactions, bundles, block_timestamp=None):
+    fixed_weth_rate = run_context["eth_prices"].get_rate(block_timestamp)
+    prefetch_pools(run_context, events)
+    transactions_index = index_transactions(transactions, run_context)
+    # token ids are shared by the bundles of the block, balances are raw amounts indexed by them
+    # and the decimals are applied once per bundle in the totals
+    token_table = TokenTable(coin_decimals)
     processed_bundles = {}
     for ii, e in enumerate(events):
         # if (e["transactionHash"] == "0xad20b98f98ce90a79c7f92d6879ac3d104e58394eefbdfefb890b23b450bfb5f" and
@@ -456,290 +572,200 @@ def process_bundles(run_context, events, transactions, bundles):
         if not e["topics"][0] in TOPICS_TO_PROCESS:
             continue
         # print(ii, TOPICS_TO_PROCESS[e["topics"][0]], e["transactionHash"])
+        kind = TOPICS_TO_PROCESS[e["topics"][0]]
+        # data words are decoded once, an event too short for its kind is skipped
+        d = decode_event(kind, e)
+        if d is None:
+            continue
         
-        for transaction in transactions:
-            if transaction["hash"] == e["transactionHash"]:
-                break
-        else:
+        if not e["transactionHash"] in transactions_index:
             continue
+        transaction, from_to = transactions_index[e["transactionHash"]]
 
-        if transaction["toTx"] in run_context["multisender_attackers"]:
-            transaction_from = None
-        else:
-            transaction_from = transaction["fromTx"]
-        if not (e["blockNumber"], transaction_from,
-                          transaction["toTx"]) in processed_bundles:
-            bundle = bundles[(e["blockNumber"], transaction_from,
-                              transaction["toTx"])].copy()
-            processed_bundles[(e["blockNumber"], transaction_from,
-                              transaction["toTx"])] = bundle
+        bundle_key = (e["blockNumber"], ) + from_to
+        if not bundle_key in processed_bundles:
+            if isinstance(bundles[bundle_key], Bundle):
+                bundle = bundles[bundle_key].copy()
+                bundle.table = token_table
+            else:
+                bundle = Bundle.from_dict(bundles[bundle_key], token_table, RECOMPUTED_FIELDS)
+            processed_bundles[bundle_key] = bundle
         else:
-            bundle = processed_bundles[(e["blockNumber"], transaction_from,
-                              transaction["toTx"])]
+            bundle = processed_bundles[bundle_key]
 
-        if TOPICS_TO_PROCESS[e["topics"][0]] == "transfer":
+        if kind == "transfer":
             make_properties(e["topics"][0], transaction, bundle)
 
-            try:
-                if (e["topics"][1] == "0x0000000000000000000000000000000000000000000000000000000000000000" or
-                    e["topics"][2] == "0x0000000000000000000000000000000000000000000000000000000000000000"):
-                    bundle["a_mintBurnNFT"] += 1
-                elif  e["topics"][2][-40:] == e["address"][-40:].lower():
-                    token = e["address"].lower()
-                    add_tokens(bundle, token)
-                    bundle["saldo"][token] -= int(e["data"],0)/coin_decimals(token)
-                    change_capital(bundle, token)
-            except:
-                pass
-                
-            update_gas(transaction, bundle)
-
-        elif TOPICS_TO_PROCESS[e["topics"][0]] == "withdraw":
-            make_properties(e["topics"][0], transaction, bundle)
-            add_tokens(bundle, WETH)
+            if d.mintBurn:
+                bundle.a_mintBurnNFT += 1
+            elif d.toToken:
+                token = e["address"].lower()
+                bundle.add_tokens(token)
+                if not d.value is None:
+                    bundle.add(token, -d.value)
+                    bundle.change_capital(token)
 
-            try:
-                amount = int(e["data"], 0) / 1e18
-            except:
-                try:
-                    amount = int(e["topics"][2], 0) / 1e18
-                except:
-                    pass
+            bundle.update_gas(transaction)
+
+        elif kind == "withdraw":
+            make_properties(e["topics"][0], transaction, bundle)
+            bundle.add_tokens(WETH)
 
-            bundle["saldo"][WETH] -= amount
-            bundle["saldo"]["eth"] += amount
+            bundle.add(WETH, -d.amount)
+            bundle.add("eth", d.amount)
 
-            change_capital(bundle, WETH)
-            update_gas(transaction, bundle)
+            bundle.change_capital(WETH)
+            bundle.update_gas(transaction)
 
-        elif TOPICS_TO_PROCESS[e["topics"][0]] == "deposit":
+        elif kind == "deposit":
             make_properties(e["topics"][0], transaction, bundle)
-            add_tokens(bundle, WETH)
-
-            try:
-                amount = int(e["data"], 0) / 1e18
-            except:
-                try:
-                    amount = int(e["topics"][2], 0) / 1e18
-                except:
-                    pass
+            bundle.add_tokens(WETH)
 
-            bundle["saldo"][WETH] += amount
-            bundle["saldo"]["eth"] -= amount
+            bundle.add(WETH, d.amount)
+            bundle.add("eth", -d.amount)
 
-            change_capital(bundle, WETH)
-            update_gas(transaction, bundle)
+            bundle.change_capital(WETH)
+            bundle.update_gas(transaction)
 
-        elif TOPICS_TO_PROCESS[e["topics"][0]] == "mint":
-            (token0, token1) = get_two_tokensV3(run_context, e["address"])
+        elif kind == "mint":
+            (token0, token1) = get_two_tokens(run_context, e["address"])
             if token0 is None:
                 continue
             make_properties(e["topics"][0], transaction, bundle, token0, token1)
-            bundle["a_mintBurnV3"] += 1
-            add_tokens(bundle, token0, token1)
-            update_gas(transaction, bundle)
+            bundle.a_mintBurnV3 += 1
+            bundle.update_gas(transaction)
 
-            bundle["saldo"][token0] -= int("0x"+e["data"][130:194],0)/coin_decimals(token0)
-            bundle["saldo"][token1] -= int("0x"+e["data"][194:258],0)/coin_decimals(token1)
-
-            change_capital(bundle, token0, token1)
+            bundle.add_pair(token0, token1, -d.amount0, -d.amount1)
             
-        elif TOPICS_TO_PROCESS[e["topics"][0]] == "collect":
-            (token0, token1) = get_two_tokensV3(run_context, e["address"])
+        elif kind == "collect":
+            (token0, token1) = get_two_tokens(run_context, e["address"])
             if token0 is None:
                 continue
             make_properties(e["topics"][0], transaction, bundle, token0, token1)
-            bundle["a_mintBurnV3"] += 1
-            add_tokens(bundle, token0, token1)
-            update_gas(transaction, bundle)
-
-            bundle["saldo"][token0] += int("0x"+e["data"][66:130],0)/coin_decimals(token0)
-            bundle["saldo"][token1] += int("0x"+e["data"][130:194],0)/coin_decimals(token1)
+            bundle.a_mintBurnV3 += 1
+            bundle.update_gas(transaction)
 
-            change_capital(bundle, token0, token1)
+            bundle.add_pair(token0, token1, d.amount0, d.amount1)
 
-        elif TOPICS_TO_PROCESS[e["topics"][0]] == "a_uniswapV2":
-            (token0, token1) = get_two_tokensV2(run_context, e["address"])
+        elif kind == "a_uniswapV2":
+            (token0, token1) = get_two_tokens(run_context, e["address"])
             if token0 is None:
                 continue
 
             make_properties(e["topics"][0], transaction, bundle, token0, token1)
-            bundle[TOPICS_TO_PROCESS[e["topics"][0]]] += 1
-            add_tokens(bundle, token0, token1)
-            update_gas(transaction, bundle)
-
-            bundle["saldo"][token0] -= int(e["data"][:66],0)/coin_decimals(token0)
-            bundle["saldo"][token0] += int("0x"+e["data"][130:194],0)/coin_decimals(token0)
-            bundle["saldo"][token1] -= int("0x"+e["data"][66:130],0)/coin_decimals(token1)
-            bundle["saldo"][token1] += int("0x"+e["data"][194:258],0)/coin_decimals(token1)
+            bundle.a_uniswapV2 += 1
+            bundle.update_gas(transaction)
+
+            bundle.add_pair(token0, token1, d.amount0Out - d.amount0In, d.amount1Out - d.amount1In)
             update_rates(bundle, token0, token1,
-                         int("0x"+e["data"][66:130], 0) +  int("0x"+e["data"][194:258], 0),
-                         int(e["data"][:66], 0) + int("0x"+e["data"][130:194], 0))
-            change_capital(bundle, token0, token1)
+                         d.amount1In + d.amount1Out,
+                         d.amount0In + d.amount0Out)
+
+        elif kind in ["a_uniswapV3", "a_pancakeV3"]:
+            (token0, token1) = get_two_tokens(run_context, e["address"])
 
-        elif TOPICS_TO_PROCESS[e["topics"][0]] in ["a_uniswapV3", "a_pancakeV3"]:
-            if TOPICS_TO_PROCESS[e["topics"][0]] == "a_uniswapV3":
-                (token0, token1) = get_two_tokensV3(run_context, e["address"])
-            else:
-                (token0, token1) = get_two_tokens_other(run_context, e["address"])
-                
             if token0 is None:
                 continue
 
             make_properties(e["topics"][0], transaction, bundle, token0, token1)
-            bundle[TOPICS_TO_PROCESS[e["topics"][0]]] += 1
-            add_tokens(bundle, token0, token1, WETH)
-            update_gas(transaction, bundle)
+            setattr(bundle, kind, getattr(bundle, kind) + 1)
+            bundle.add_tokens(token0, token1, WETH)
+            bundle.update_gas(transaction)
 
-            bundle["saldo"][token0] -= s64(int(e["data"][:66],0))/coin_decimals(token0)
-            bundle["saldo"][token1] -= s64(int("0x"+e["data"][66:130],0))/coin_decimals(token1)
-            update_rates(bundle, token0, token1,
-                         s64(int("0x"+e["data"][66:130],0)),
-                         s64(int(e["data"][:66],0)))
-            change_capital(bundle, token0, token1)
+            bundle.add_pair(token0, token1, -d.amount0, -d.amount1)
+            update_rates(bundle, token0, token1, d.amount1, d.amount0)
 
 # calculate bundle totals
     output_bundles = {}
     for ii, b in enumerate(processed_bundles):
         bundle = processed_bundles[b]
         
-        bundle["a_irreducibleTokens"] = 0
-        bundle["a_baseToken"] = None
-        if not "rates" in bundle or len(bundle["rates"]) == 0:
+        bundle.a_irreducibleTokens = 0
+        bundle.a_baseToken = None
+        if getattr(bundle, "rates", None) is None or len(bundle.rates) == 0:
             continue
-        bundle["capitalRequirements_1"] = {}
-        if WETH in bundle["capitalRequirements"]:
-            bundle["a_baseToken"] = WETH
+        # raw amounts are scaled by the token decimals once here
+        saldo, capital_requirements = bundle.balances()
+        capital_requirements_1 = {}
+        bundle.capitalRequirements_1 = capital_requirements_1
+        if WETH in capital_requirements:
+            bundle.a_baseToken = WETH
         else:
             for st in STABLECOINS:
-                if st in bundle["capitalRequirements"]:
-                    bundle["a_baseToken"] = st
-        if bundle["a_baseToken"] is None:
+                if st in capital_requirements:
+                    bundle.a_baseToken = st
+        base_token = bundle.a_baseToken
+        if base_token is None:
             continue
         
+        # stablecoins not connected to WETH or to each other by the bundle's own swaps get virtual pairs
+        rates = bundle.rates
+        rate_graph = RateGraph(rates)
         for st in STABLECOINS:
-            if WETH in bundle["capitalRequirements"] and st in bundle["capitalRequirements"]:
-                if find_rate(WETH, st, bundle["rates"]) is None:
-                    if WETH < st:
-                        bundle["rates"][(WETH, st)] = fixed_weth_rate
-                    else:
-                        bundle["rates"][(st, WETH)] = 1/fixed_weth_rate
+            if WETH in capital_requirements and st in capital_requirements:
+                if not rate_graph.connected(WETH, st):
+                    pair = (WETH, st) if WETH < st else (st, WETH)
+                    rates[pair] = fixed_weth_rate if WETH < st else 1/fixed_weth_rate
+                    rate_graph.add(pair, rates[pair])
             for st1 in STABLECOINS:
-                if st != st1 and st1 in bundle["capitalRequirements"] and st in bundle["capitalRequirements"]:
-                    if find_rate(st1, st, bundle["rates"]) is None:
-                        bundle["rates"][min(st1, st), max(st1, st)] = 1
-        
-        bundle["totalCapital"] = 0
-        bundle["profitEstimation"] = 0
-        for c in bundle["capitalRequirements"]:
-            if (c == "eth" or c == WETH) and bundle["a_baseToken"] == WETH:
+                if st != st1 and st1 in capital_requirements and st in capital_requirements:
+                    if not rate_graph.connected(st1, st):
+                        rates[min(st1, st), max(st1, st)] = 1
+                        rate_graph.add((min(st1, st), max(st1, st)), 1)
+        # number of each token for 1 base token, eth is priced as WETH
+        prices = rate_graph.prices(base_token)
+        if WETH in prices:
+            prices["eth"] = prices[WETH]
+
+        total_capital = 0
+        profit_estimation = 0
+        for c in capital_requirements:
+            if (c == "eth" or c == WETH) and base_token == WETH:
                 rate = 1
-            elif bundle["a_baseToken"] == c:
+            elif base_token == c:
                 rate = 1
             else:
-                rate = find_rate(bundle["a_baseToken"], c, bundle["rates"])
+                rate = prices.get(c)
                 if rate is None:
-                    bundle["a_irreducibleTokens"] = 1
+                    bundle.a_irreducibleTokens = 1
                     continue
-            bundle["capitalRequirements_1"][c] = bundle["capitalRequirements"][c] / rate
-            bundle["totalCapital"] += bundle["capitalRequirements_1"][c]
-            bundle["profitEstimation"] += bundle["saldo"][c] / rate
-
-        if bundle["a_baseToken"] in STABLECOINS:
-            bundle["totalCapital"] = bundle["totalCapital"] / fixed_weth_rate
-            bundle["profitEstimation"] = bundle["profitEstimation"] / fixed_weth_rate
-        bundle["ETHCapital"] = bundle["capitalRequirements"]["eth"]
-        bundle["ETHTotal"] = bundle["saldo"]["eth"]
-        max_capitalRequirements = max(list(bundle["capitalRequirements_1"].values()))
-        bundle["a_startToken"] = list(bundle["capitalRequirements_1"].keys())[list(bundle["capitalRequirements_1"].values()).index(max_capitalRequirements)]
-        bundle["a_complexity"] = len(bundle["txs"])
-        bundle["a_N_startTokens"] = len([1 for c in bundle["capitalRequirements"] if bundle["capitalRequirements"][c] > 0 and c != 'eth'])
-
-        bundle["beforeBribes"] = bundle['profitEstimation'] + bundle['directBribe'] + bundle['gasOverpay']
-        if bundle["beforeBribes"] > 0:
-            bundle["bribesRatio"] = (bundle['directBribe'] + bundle['gasOverpay']) / bundle["beforeBribes"]
+            capital_requirements_1[c] = capital_requirements[c] / rate
+            total_capital += capital_requirements_1[c]
+            profit_estimation += saldo[c] / rate
+
+        if base_token in STABLECOINS:
+            total_capital = total_capital / fixed_weth_rate
+            profit_estimation = profit_estimation / fixed_weth_rate
+        bundle.totalCapital = total_capital
+        bundle.profitEstimation = profit_estimation
+        bundle.ETHCapital = capital_requirements["eth"]
+        bundle.ETHTotal = saldo["eth"]
+        max_capitalRequirements = max(list(capital_requirements_1.values()))
+        bundle.a_startToken = list(capital_requirements_1.keys())[list(capital_requirements_1.values()).index(max_capitalRequirements)]
+        bundle.a_complexity = len(bundle.txs)
+        bundle.a_N_startTokens = len([1 for c in capital_requirements if capital_requirements[c] > 0 and c != 'eth'])
+
+        bundle.beforeBribes = profit_estimation + bundle.directBribe + bundle.gasOverpay
+        if bundle.beforeBribes > 0:
+            bundle.bribesRatio = (bundle.directBribe + bundle.gasOverpay) / bundle.beforeBribes
         else:
-            bundle["bribesRatio"] = None
+            bundle.bribesRatio = None
         output_bundles[b] = bundle
     return output_bundles
 
 def check_attack_class(rules, bundle):
-    for r in rules:
-        if r in bundle:
-            value = bundle[r]
-        else:
-            value = 0 #!!! may be problematic with string properties
-        if rules[r][0] == "EQ":
-            if rules[r][1] != value:
-                return False
-        if rules[r][0] == "NE":
-            if rules[r][1] == value:
-                return False
-        elif rules[r][0] == "GT":
-            if rules[r][1] >= value:
-                return False
-        elif rules[r][0] == "GE":
-            if rules[r][1] > value:
-                return False
-        elif rules[r][0] == "LT":
-            if rules[r][1] <= value:
-                return False
-        elif rules[r][0] == "LE":
-            if rules[r][1] < value:
-                return False
-    return True
+    return compile_rules(rules)(bundle)
 
 @provide_db
-def classes_and_emas(bundles, attakers_list, db):
-# with RemoteServer(remote=REMOTE) as server:
-   # with DBMySQL(port=server.local_bind_port) as db:
-    attack_classes = db.get_attack_classes()
-    attack_EMAs_list = db.get_attack_EMAs()
-            
-    attack_EMAs = {(a["attackClassId"], a["attacker"]): a for a in attack_EMAs_list}
-    for c in attack_classes:
-        c["rules"] = json.loads(c["rules"])
-
-    for b in bundles:
-        if not "saldo" in bundles[b] or bundles[b]["saldo"] is None:
-            continue
-        report_by_attackers = ["*"]
-        for a in attakers_list:
-            if a["tx_to"] == b[2]:
-                if a["report"] in [1, 2]:
-                    report_by_attackers.append(b[2])
-            else:
-                if a["report"] == 2:
-                    report_by_attackers.append("~" + a["tx_to"])
-               
-        for c in attack_classes:
-            if not bundles[b]["bribesRatio"] is None and check_attack_class(c["rules"], bundles[b]):
-                for a in report_by_attackers:
-                    if not (c["attackClassId"], a) in attack_EMAs:
-                        attack_EMAs[(c["attackClassId"], a)] = {"countAttacks": 1,
-                                                            "lastBlockNumber": None,
-                                                           "bribesRatio": None,
-                                                           "bribesRatioEMA": None
-                                                           }
-                    if attack_EMAs[(c["attackClassId"], a)]["bribesRatioEMA"] is None:
-                        attack_EMAs[(c["attackClassId"], a)]["bribesRatioEMA"] = bundles[b]["bribesRatio"]
-                    else:
-                        attack_EMAs[(c["attackClassId"], a)]["bribesRatioEMA"] = (bundles[b]["bribesRatio"] * parameters["EMA_alpha"] + 
-                                                        attack_EMAs[(c["attackClassId"], a)]["bribesRatioEMA"] * (1 - parameters["EMA_alpha"]))
-                        attack_EMAs[(c["attackClassId"], a)]["countAttacks"] += 1
-                    attack_EMAs[(c["attackClassId"], a)]["lastBlockNumber"] = b[0]
-                    attack_EMAs[(c["attackClassId"], a)]["bribesRatio"] = bundles[b]["bribesRatio"]
-
-                    db.add_attack(bundles[b]["bundleId"], c["attackClassId"], a, b[0],
-                                  bundles[b]["bribesRatio"])
-
-# with RemoteServer(remote=REMOTE) as server:
-   # with DBMySQL(port=server.local_bind_port) as db:
-        for c in attack_EMAs:
-            db.update_attack_EMA(c[0], c[1], attack_EMAs[c]["countAttacks"],
-                                 attack_EMAs[c]["lastBlockNumber"],
-                                 attack_EMAs[c]["bribesRatio"],
-                                 attack_EMAs[c]["bribesRatioEMA"])
+def classes_and_emas(bundles, attakers_list, db, emas=None):
+    # without a resident engine the EMAs are loaded, updated and written back for this call only
+    if emas is None:
+        emas = EMAEngine(parameters["EMA_alpha"])
+        emas.classify(bundles, attakers_list, db)
+        emas.flush(db)
+    else:
+        emas.classify(bundles, attakers_list, db)
+        emas.maybe_flush(db)
 
 
 def recalc_attacks(start_bundle = None):
@@ -752,40 +778,51 @@ def recalc_attacks(start_bundle = None):
             attakers_list = db.get_attackers()
             l = db.exec_sql_plain_list(s1)
 
+    # every bundle stays in memory, they are kept as Bundles sharing one token table
     all_bundles = {}
+    token_table = TokenTable(coin_decimals)
     with RemoteServer(remote=REMOTE) as server:
         with DBMySQL(port=server.local_bind_port) as db:
             for ll in l[1]:
                 block_bundles = db.get_bundles(ll[0])
                 block_bundles = {(b["blockNumber"], b["attacker0"], b["attacker1"]): b for b in block_bundles}
                 for b in block_bundles:
-                    if not block_bundles[b]["capitalRequirements"] is None:
-                        block_bundles[b]["capitalRequirements"] = json.loads(block_bundles[b]["capitalRequirements"])
-                    if not block_bundles[b]["saldo"] is None:
-                        block_bundles[b]["saldo"] = json.loads(block_bundles[b]["saldo"])
-                    if not block_bundles[b]["rates"] is None:
-                        block_bundles[b]["rates"] = {(r[0], r[1]): r[2] for r in json.loads(block_bundles[b]["rates"])}
-                    if not block_bundles[b]["features"] is None:
-                        features = json.loads(block_bundles[b]["features"])
-                        block_bundles[b].update(features)
-                all_bundles.update(block_bundles)
+                    row = block_bundles[b]
+                    bundle = Bundle()
+                    bundle.table = token_table
+                    for k in row:
+                        if not k in ["capitalRequirements", "saldo", "rates", "features"]:
+                            bundle[k] = row[k]
+                    if not row["saldo"] is None:
+                        bundle["saldo"] = json.loads(row["saldo"])
+                    if not row["capitalRequirements"] is None:
+                        bundle["capitalRequirements"] = json.loads(row["capitalRequirements"])
+                    if not row["rates"] is None:
+                        bundle["rates"] = {(r[0], r[1]): r[2] for r in json.loads(row["rates"])}
+                    if not row["features"] is None:
+                        features = json.loads(row["features"])
+                        for k in features:
+                            bundle[k] = features[k]
+                    all_bundles[b] = bundle
     print("len(all_bundles)=", len(all_bundles))
 
     with RemoteServer(remote=REMOTE) as server:
         with DBMySQL(port=server.local_bind_port) as db:
-            attack_classes = db.get_attack_classes()
-            for c in attack_classes:
-                c["rules"] = json.loads(c["rules"])
+            attack_classes = compile_attack_classes(db.get_attack_classes())
+    # all bundles are classified at once, a row per bundle and a column per class
+    classified_bundles = [b for b in all_bundles if "saldo" in all_bundles[b] and not all_bundles[b]["saldo"] is None and
+                          not all_bundles[b]["bribesRatio"] is None]
+    matches = classify_bundles([all_bundles[b] for b in classified_bundles], attack_classes).values
+    bundle_rows = {b: i for i, b in enumerate(classified_bundles)}
 
     with RemoteServer(remote=REMOTE) as server:
         with DBMySQL(port=server.local_bind_port) as db:
+            emas = make_ema_engine()
             if start_bundle is None:
                 s1 = "delete from t_attack_EMAs"
                 db.exec_sql(s1)
-                attack_EMAs = {}
             else:
-                attack_EMAs_list = db.get_attack_EMAs()
-                attack_EMAs = {(a["attackClassId"], a["attacker"]): a for a in attack_EMAs_list}
+                emas.load(db, replay=False)
 
     # recalc attacks and save all to db
     with RemoteServer(remote=REMOTE) as server:
@@ -805,44 +842,20 @@ def recalc_attacks(start_bundle = None):
                        
                 s1 = "delete from t_attacks where bundleId = " + str(all_bundles[b]["bundleId"])
                 db.exec_sql(s1)
-                for c in attack_classes:
-                    if not all_bundles[b]["bribesRatio"] is None and check_attack_class(c["rules"], all_bundles[b]):
+                for ci, c in enumerate(attack_classes):
+                    if b in bundle_rows and matches[bundle_rows[b], ci]:
                         for a in report_by_attackers:
                             db.add_attack(all_bundles[b]["bundleId"], c["attackClassId"], a, b[0],
                                           all_bundles[b]["bribesRatio"])
-                            if not (c["attackClassId"], a) in attack_EMAs:
-                                attack_EMAs[(c["attackClassId"], a)] = {"countAttacks": 1,
-                                                                    "lastBlockNumber": None,
-                                                                   "bribesRatio": None,
-                                                                   "bribesRatioEMA": None
-                                                                   }
-                            if attack_EMAs[(c["attackClassId"], a)]["bribesRatioEMA"] is None:
-                                attack_EMAs[(c["attackClassId"], a)]["bribesRatioEMA"] = all_bundles[b]["bribesRatio"]
-                            else:
-                                attack_EMAs[(c["attackClassId"], a)]["bribesRatioEMA"] = (all_bundles[b]["bribesRatio"] * parameters["EMA_alpha"] + 
-                                                                attack_EMAs[(c["attackClassId"], a)]["bribesRatioEMA"] * (1 - parameters["EMA_alpha"]))
-                                attack_EMAs[(c["attackClassId"], a)]["countAttacks"] += 1
-                            attack_EMAs[(c["attackClassId"], a)]["lastBlockNumber"] = b[0]
-                            attack_EMAs[(c["attackClassId"], a)]["bribesRatio"] = all_bundles[b]["bribesRatio"]
+                            emas.update((c["attackClassId"], a), b[0], all_bundles[b]["bribesRatio"])
                 db.commit()
 
     with RemoteServer(remote=REMOTE) as server:
         with DBMySQL(port=server.local_bind_port) as db:
-            for c in attack_EMAs:
-                db.update_attack_EMA(c[0], c[1], attack_EMAs[c]["countAttacks"],
-                                     attack_EMAs[c]["lastBlockNumber"],
-                                     attack_EMAs[c]["bribesRatio"],
-                                     attack_EMAs[c]["bribesRatioEMA"])
-
+            emas.flush(db)
 
-def recalc_bundles():
-    block_number = 19356000
-    max_block_number = 19360530
 
-    w3, latest_block, uris = web3connect2(KEY_FILE)
-    with RemoteServer(remote=REMOTE) as server:
-        with DBMySQL(port=server.local_bind_port) as db:
-            attakers_list = db.get_attackers()
+def make_run_context(w3, attakers_list):
     attakers = {}
     multisender_attackers = []
     for a in attakers_list:
@@ -850,9 +863,10 @@ def recalc_bundles():
         if a["tx_from"] is None and a["status"] == 1:
             multisender_attackers.append(a["tx_to"])
  
-    abi_storage = {}
-    contract_storage = {}
-    pairs_VXXX = {}
+    stats = {}
+    abi_storage = LRUCache("abis", max_bytes=parameters.get("ABI_CACHE_BYTES", 64 * 2**20), stats=stats)
+    contract_storage = LRUCache("contracts", max_items=parameters.get("CONTRACT_CACHE_ITEMS", 1000), stats=stats)
+    pairs_VXXX = PoolStore(max_items=parameters.get("POOL_CACHE_ITEMS", 500000), stats=stats)
     run_context = {
                     "w3": w3,
                     "etherscan_key": ETHERSCAN_KEY,
@@ -861,20 +875,235 @@ def recalc_bundles():
                     "contract_storage": contract_storage,
                     "attaker_status": attakers,
                     "multisender_attackers": multisender_attackers,
+                    "receipts_mode": parameters.get("RECEIPTS_MODE", "block"),
+                    "stats": stats,
+                    "bribes_cache": {},
                     }
-    run_context["eth_rate"] = float(etherscan_get_ethusd(run_context["etherscan_key"])["ethusd"])
+    negative_ttl = parameters.get("NEGATIVE_CACHE_TTL", 86400)
+    run_context["bad_pools"] = NegativeCache("pool", negative_ttl, run_context["stats"])
+    run_context["bad_abis"] = NegativeCache("abi", negative_ttl, run_context["stats"])
+    run_context["eth_prices"] = get_eth_prices()
+    run_context["tokens"] = TOKEN_STORE
+    run_context["emas"] = make_ema_engine()
+    return run_context
+
+def make_ema_engine():
+    return EMAEngine(parameters["EMA_alpha"], parameters.get("EMA_FLUSH_BLOCKS", 100), parameters.get("EMA_FLUSH_SECONDS", 60))
+
+def recalc_bundles(block_number=19356000, max_block_number=19360530):
 
+    w3, latest_block, uris = web3connect2(KEY_FILE)
     with RemoteServer(remote=REMOTE) as server:
         with DBMySQL(port=server.local_bind_port) as db:
+            attakers_list = db.get_attackers()
+            run_context = make_run_context(w3, attakers_list)
+            load_stores(run_context, db)
+            # stored blocks are priced at their own time, not at today's live price
+            preload_eth_prices(w3, block_number, db, historical=True)
+            emas = run_context["emas"]
+            emas.load(db, replay=False)
             while block_number <= max_block_number:
                 print(block_number)
                 block_data, transactions, events, bundles = get_block_data(block_number, db=db)
-                # output_bundles = process_bundles(run_context, events, transactions, bundles)
-                classes_and_emas(bundles, attakers_list, db=db)
+                # t_blocks keeps no timestamp, it is read from the node
+                block_timestamp = w3.eth.get_block(block_number)["timestamp"]
+                output_bundles = process_bundles(run_context, events, transactions, bundles, block_timestamp)
+                output_bundles = bundles_to_dicts(output_bundles)
+                update_bundles(output_bundles, db=db)
+                # the block's attacks are written again, the EMAs in memory are not flushed
+                db.clean_block_attacks(block_number)
+                emas.classify(output_bundles, attakers_list, db)
+                flush_stores(run_context, db)
                 db.commit()
                 block_number += 1
+            # the recalculated blocks precede attacks already folded into the stored EMAs
+            emas.rebuild(db)
+            emas.flush(db)
+            db.commit()
+
+def fetch_and_process_block(block_number, run_context, block=None, block_logs=None):
+    block_data, block_transactions, block_events, block_bundles = process_block(block_number, run_context, block, block_logs)
+
+    # events, transactions, bundles = block_events, block_transactions, block_bundles
+    # block_data, transactions, events, bundles = get_block_data(19360531)
+
+    output_bundles = process_bundles(run_context, block_events, block_transactions, block_bundles, block_data["timestamp"])
+    return block_data, block_transactions, block_events, output_bundles
+
+def load_stores(run_context, db):
+    run_context["tokens"].load(db)
+    run_context["pairs_VXXX"].load(db)
+    run_context["bad_pools"].load(db)
+    run_context["bad_abis"].load(db)
+
+def flush_stores(run_context, db):
+    run_context["tokens"].flush(db)
+    run_context["pairs_VXXX"].flush(db)
+    run_context["bad_pools"].flush(db)
+    run_context["bad_abis"].flush(db)
+
+def persist_block(block_data, block_transactions, block_events, output_bundles, attakers_list, db, run_context=None):
+    output_bundles = bundles_to_dicts(output_bundles)
+    write_block_transactions(block_data, block_transactions, block_events, output_bundles, db=db)
+    update_bundles(output_bundles, db=db)
+    classes_and_emas(output_bundles, attakers_list, db=db, emas=None if run_context is None else run_context["emas"])
+    if not run_context is None:
+        flush_stores(run_context, db)
+    db.commit()
 
-def process_historical_blocks(w3, latest_block):
+async def ingest_blocks(run_context, attakers_list, first_block_number, last_block_number, concurrency, db):
+    # up to concurrency blocks are fetched and processed in worker threads,
+    # results are persisted strictly in block order so the EMAs stay deterministic
+    loop = asyncio.get_running_loop()
+    in_flight = deque()
+    block_number = first_block_number
+    run_context["last_block_number"] = last_block_number
+    # the live ranges end at the newest head
+    run_context["head_block_number"] = max(run_context.get("head_block_number", 0), last_block_number)
+    with ThreadPoolExecutor(max_workers=concurrency + 1) as executor:
+        try:
+            while block_number <= last_block_number or len(in_flight):
+                while block_number <= last_block_number and len(in_flight) < concurrency:
+                    in_flight.append((block_number, loop.run_in_executor(executor, fetch_and_process_block, block_number, run_context)))
+                    block_number += 1
+                next_block_number, block_future = in_flight.popleft()
+                block_data, block_transactions, block_events, output_bundles = await block_future
+                print(next_block_number)
+                await loop.run_in_executor(executor, persist_block, block_data, block_transactions, block_events,
+                                           output_bundles, attakers_list, db, run_context)
+                run_context["persisted_block_number"] = next_block_number
+        finally:
+            for _, block_future in in_flight:
+                block_future.cancel()
+    print("stats", run_context["stats"])
+
+def scan_blocks_by_logs(run_context, first_block_number, last_block_number):
+    # one eth_getLogs per LOGS_BLOCK_RANGE blocks on the processed topics, blocks are fetched in json-rpc batches
+    # and receipts are requested only for the transactions that end up in bundles
+    w3 = run_context["w3"]
+    logs_block_range = parameters.get("LOGS_BLOCK_RANGE", 2000)
+    window = {"span": logs_block_range, "max_span": logs_block_range}
+    for range_start in range(first_block_number, last_block_number + 1, logs_block_range):
+        range_end = min(range_start + logs_block_range - 1, last_block_number)
+        logs_by_block = {}
+        for log in get_logs_range(w3, range_start, range_end, TOPICS_TO_PROCESS, window=window, stats=run_context["stats"]):
+            if not log["blockNumber"] in logs_by_block:
+                logs_by_block[log["blockNumber"]] = []
+            logs_by_block[log["blockNumber"]].append(log)
+        for batch_start in range(range_start, range_end + 1, MAX_BATCH):
+            blocks = get_blocks_batch(w3, range(batch_start, min(batch_start + MAX_BATCH - 1, range_end) + 1),
+                                      stats=run_context["stats"])
+            for block_number in sorted(blocks):
+                yield block_number, fetch_and_process_block(block_number, run_context, blocks[block_number],
+                                                            logs_by_block.get(block_number, []))
+
+def backfill_shard(shard):
+    # runs in a worker process with its own node and db connections
+    first_block_number, last_block_number = shard
+    w3, latest_block, uris = web3connect2(KEY_FILE)
+    shard_bundles = []
+    with RemoteServer(remote=REMOTE) as server:
+        with DBMySQL(port=server.local_bind_port) as db:
+            attakers_list = db.get_attackers()
+            run_context = make_run_context(w3, attakers_list)
+            run_context["eth_prices"].set_history(db.get_eth_prices(), historical=True)
+            load_stores(run_context, db)
+            run_context["last_block_number"] = last_block_number
+            run_context["head_block_number"] = latest_block["number"]
+            if parameters.get("BACKFILL_MODE", "receipts") == "logs":
+                processed_blocks = scan_blocks_by_logs(run_context, first_block_number, last_block_number)
+            else:
+                processed_blocks = ((b, fetch_and_process_block(b, run_context)) for b in range(first_block_number, last_block_number + 1))
+            for block_number, (block_data, block_transactions, block_events, output_bundles) in processed_blocks:
+                output_bundles = bundles_to_dicts(output_bundles)
+                clean_block_data(block_number, db=db)
+                write_block_transactions(block_data, block_transactions, block_events, output_bundles, db=db)
+                update_bundles(output_bundles, db=db)
+                flush_stores(run_context, db)
+                db.commit()
+                shard_bundles.append((block_number, output_bundles))
+    print("shard done", first_block_number, last_block_number, run_context["stats"])
+    return shard_bundles
+
+def init_backfill_worker(workers):
+    # a forked worker does not inherit the parent's refresh thread, it starts its own price service
+    global ETH_PRICES
+    ETH_PRICES = None
+    configure_etherscan(workers)
+
+def backfill_blocks(first_block_number, last_block_number, workers=None, shard_size=None):
+    if workers is None:
+        workers = parameters.get("BACKFILL_WORKERS", os.cpu_count())
+    if shard_size is None:
+        shard_size = parameters.get("BACKFILL_SHARD_SIZE", 1000)
+    shards = [(b, min(b + shard_size - 1, last_block_number)) for b in range(first_block_number, last_block_number + 1, shard_size)]
+
+    with RemoteServer(remote=REMOTE) as server:
+        with DBMySQL(port=server.local_bind_port) as db:
+            attakers_list = db.get_attackers()
+            # price history is completed once here, the workers only read it,
+            # historical blocks are not priced at today's live price
+            w3, latest_block, uris = web3connect2(KEY_FILE)
+            preload_eth_prices(w3, first_block_number, db, historical=True)
+            emas = make_ema_engine()
+            emas.load(db, replay=False)
+            with multiprocessing.Pool(workers, initializer=init_backfill_worker, initargs=(workers,)) as pool:
+                # imap returns shards in order, only the attacks are written here, the EMAs in memory are not flushed
+                for shard_bundles in pool.imap(backfill_shard, shards):
+                    for block_number, output_bundles in shard_bundles:
+                        emas.classify(output_bundles, attakers_list, db)
+                    db.commit()
+            # the backfilled blocks precede attacks already folded into the stored EMAs,
+            # so the EMAs and their lastBlockNumber are recomputed from t_attacks in block order
+            emas.rebuild(db)
+            emas.flush(db)
+            db.commit()
+
+INGEST_RETRY_DELAY = 1
+MAX_INGEST_RETRY_DELAY = 60
+
+async def tail_blocks(run_context, attakers_list, wss_url, last_block_number, db):
+    # server_output_module reads t_attack_EMAs, so every head's EMAs are flushed with its block,
+    # batched flushing is left to backfills and the catch-up before the tail
+    run_context["emas"].flush_blocks = 1
+    run_context["emas"].flush_seconds = 0
+    heads = asyncio.Queue()
+    subscriber = asyncio.create_task(subscribe_new_heads(wss_url, heads.put))
+    head_number = last_block_number
+    delay = INGEST_RETRY_DELAY
+    try:
+        while True:
+            # a failed range is retried right away, otherwise the next head is awaited
+            if head_number <= last_block_number:
+                next_head = asyncio.ensure_future(heads.get())
+                await asyncio.wait([next_head, subscriber], return_when=asyncio.FIRST_COMPLETED)
+                if subscriber.done():
+                    next_head.cancel()
+                    subscriber.result()
+                head_number = max(head_number, int(next_head.result()["number"], 16))
+            while not heads.empty():
+                head_number = max(head_number, int(heads.get_nowait()["number"], 16))
+            if head_number > last_block_number:
+                # blocks missed while resubscribing are picked up here as well
+                run_context["persisted_block_number"] = last_block_number
+                try:
+                    await ingest_blocks(run_context, attakers_list, last_block_number + 1, head_number,
+                                        parameters.get("INGEST_CONCURRENCY", 1), db=db)
+                    delay = INGEST_RETRY_DELAY
+                except Exception as e:
+                    # ingestion resumes after the last persisted block, a block written in part is rolled back
+                    # and the EMAs are reloaded from the committed attacks
+                    print("blocks not ingested, retrying in", delay, repr(e))
+                    count_stats(run_context, "ingest_retries")
+                    db.rollback()
+                    run_context["emas"].load(db)
+                    await asyncio.sleep(delay)
+                    delay = min(delay * 2, MAX_INGEST_RETRY_DELAY)
+                last_block_number = run_context["persisted_block_number"]
+    finally:
+        subscriber.cancel()
+
+def process_historical_blocks(w3, latest_block, wss_url=None):
 
     latest_block_number = latest_block["number"]
 
@@ -882,26 +1111,7 @@ def process_historical_blocks(w3, latest_block):
         with DBMySQL(port=server.local_bind_port) as db:
             attakers_list = db.get_attackers()
             prev_block = db.get_blocks_gap(latest_block_number)
-    attakers = {}
-    multisender_attackers = []
-    for a in attakers_list:
-        attakers[a["tx_from"], a["tx_to"]] = a["status"]
-        if a["tx_from"] is None and a["status"] == 1:
-            multisender_attackers.append(a["tx_to"])
- 
-    abi_storage = {}
-    contract_storage = {}
-    pairs_VXXX = {}
-    run_context = {
-                    "w3": w3,
-                    "etherscan_key": ETHERSCAN_KEY,
-                    "abi_storage": abi_storage,
-                    "pairs_VXXX": pairs_VXXX,
-                    "contract_storage": contract_storage,
-                    "attaker_status": attakers,
-                    "multisender_attackers": multisender_attackers,
-                    }
-    run_context["eth_rate"] = float(etherscan_get_ethusd(run_context["etherscan_key"])["ethusd"])
+    run_context = make_run_context(w3, attakers_list)
 
     # print(latest_block_number)
     block_number = min(prev_block + 1, latest_block_number) if not prev_block is None else latest_block_number
@@ -910,21 +1120,16 @@ def process_historical_blocks(w3, latest_block):
     # clean_block_data(block_number)
 
     print(latest_block_number - block_number)
-    while block_number <= latest_block_number:
-        print(block_number)
-        block_data, block_transactions, block_events, block_bundles = process_block(block_number, run_context)
-
-        # events, transactions, bundles = block_events, block_transactions, block_bundles
-        # block_data, transactions, events, bundles = get_block_data(19360531)
-
-        output_bundles = process_bundles(run_context, block_events, block_transactions, block_bundles)
-        with RemoteServer(remote=REMOTE) as server:
-            with DBMySQL(port=server.local_bind_port) as db:
-                write_block_transactions(block_data, block_transactions, block_events, output_bundles, db=db)
-                update_bundles(output_bundles, db=db)
-                classes_and_emas(output_bundles, attakers_list, db=db)
-                db.commit()
-        block_number += 1
+    with RemoteServer(remote=REMOTE) as server:
+        with DBMySQL(port=server.local_bind_port) as db:
+            preload_eth_prices(w3, block_number, db)
+            load_stores(run_context, db)
+            asyncio.run(ingest_blocks(run_context, attakers_list, block_number, latest_block_number,
+                                      parameters.get("INGEST_CONCURRENCY", 1), db=db))
+            run_context["emas"].flush(db)
+            db.commit()
+            if not wss_url is None:
+                asyncio.run(tail_blocks(run_context, attakers_list, wss_url, latest_block_number, db=db))
 
 def management():
     
@@ -978,6 +1183,11 @@ def main():
         process_historical_blocks(w3, latest_block)
     elif sys.argv[1] == "recalc" and sys.argv[2] == "attacks":
         recalc_attacks()
+    elif sys.argv[1] == "tail":
+        w3, latest_block, uris = web3connect2(KEY_FILE)
+        process_historical_blocks(w3, latest_block, wss_url=uris["alchemy_wss"])
+    elif sys.argv[1] == "backfill":
+        backfill_blocks(int(sys.argv[2]), int(sys.argv[3]), workers=(int(sys.argv[4]) if len(sys.argv) > 4 else None))
     
 if __name__ == '__main__':
     # recalc_bundles()
@@ -38,6 +38,9 @@ class DBMySQL(object):
     def commit(self):
         self.db_connection.commit()
 
+    def rollback(self):
+        self.db_connection.rollback()
+
     def stop(self):
         self.db_connection.commit()
         self.db_connection.close()
@@ -167,6 +170,25 @@ class DBMySQL(object):
             s2 += " DATA DIRECTORY = '/media/data/mysql'"
             self._create_table(s1, s2)
 
+        if "t_eth_prices" in tables:
+            s1 = "DROP TABLE t_eth_prices"
+            s2 = "CREATE TABLE t_eth_prices (timestamp INT NOT NULL PRIMARY KEY, price DOUBLE)"
+            s2 += " DATA DIRECTORY = '/media/data/mysql'"
+            self._create_table(s1, s2)
+
+        if "t_pools" in tables:
+            s1 = "DROP TABLE t_pools"
+            s2 = "CREATE TABLE t_pools (pool VARCHAR(256) NOT NULL PRIMARY KEY, token0 VARCHAR(256), token1 VARCHAR(256))"
+            s2 += " DATA DIRECTORY = '/media/data/mysql'"
+            self._create_table(s1, s2)
+
+        if "t_bad_contracts" in tables:
+            s1 = "DROP TABLE t_bad_contracts"
+            s2 = "CREATE TABLE t_bad_contracts (address VARCHAR(256) NOT NULL, kind VARCHAR(64) NOT NULL, expires INT, reason VARCHAR(1024), "
+            s2 += "PRIMARY KEY(address, kind))"
+            s2 += " DATA DIRECTORY = '/media/data/mysql'"
+            self._create_table(s1, s2)
+
     def clean_block_data(self, block_number):
         s0 = "delete from t_blocks where blockNumber = %s"
         s1 = "delete from t_event_topics where t_event_topics.eventId in (select eventId from t_events where blockNumber = %s)"
@@ -183,6 +205,12 @@ class DBMySQL(object):
         self.cursor.execute(s5, (block_number, ))
         self.cursor.execute(s6, (block_number, ))
 
+    def clean_block_attacks(self, block_number):
+        s1 = "delete from t_attack_events where blockNumber = %s"
+        s2 = "delete from t_attacks where blockNumber = %s"
+        self.cursor.execute(s1, (block_number, ))
+        self.cursor.execute(s2, (block_number, ))
+
     def get_blocks_gap(self, block_number):
         s0 = "select max(blockNumber) from t_blocks where blockNumber<%s"
         l = self.cursor.execute(s0, (block_number, ))
@@ -305,6 +333,17 @@ class DBMySQL(object):
             s2 = "insert into t_attack_EMAs(attackClassId, attacker, countAttacks, lastBlockNumber, bribesRatio, bribesRatioEMA) values(%s, %s, %s, %s, %s, %s)"
             self.cursor.execute(s2, (attackClassId, attacker, countAttacks, lastBlockNumber, bribesRatio, bribesRatioEMA))
 
+    def update_attack_EMAs(self, attack_EMAs):
+        # (attackClassId, attacker, countAttacks, lastBlockNumber, bribesRatio, bribesRatioEMA) rows in one upsert
+        s1 = "insert into t_attack_EMAs(attackClassId, attacker, countAttacks, lastBlockNumber, bribesRatio, bribesRatioEMA) values(%s, %s, %s, %s, %s, %s) "
+        s1 += "on duplicate key update countAttacks=values(countAttacks), lastBlockNumber=values(lastBlockNumber), bribesRatio=values(bribesRatio), bribesRatioEMA=values(bribesRatioEMA)"
+        self.cursor.executemany(s1, attack_EMAs)
+
+    def get_attacks_after(self, block_number):
+        s1 = "select attackClassId, attacker, blockNumber, bribesRatio from t_attacks where blockNumber > %s order by blockNumber, bundleId"
+        self.cursor.execute(s1, (block_number, ))
+        return self.fetch_with_description(self.cursor)
+
     def get_attack_classes(self):
         s1 = "select * from t_attack_classes "
         self.cursor.execute(s1)
@@ -406,6 +445,25 @@ class DBMySQL(object):
         self.cursor.execute(s1)
         return self.fetch_with_description(self.cursor)
 
+    def add_pools(self, pools):
+        s1 = "insert into t_pools(pool, token0, token1) values(%s, %s, %s) on duplicate key update token0=values(token0), token1=values(token1)"
+        self.cursor.executemany(s1, pools)
+
+    def get_pools(self):
+        s1 = "select pool, token0, token1 from t_pools"
+        self.cursor.execute(s1)
+        return self.fetch_with_description(self.cursor)
+
+    def add_bad_contracts(self, bad_contracts):
+        s1 = "insert into t_bad_contracts(address, kind, expires, reason) values(%s, %s, %s, %s) "
+        s1 += "on duplicate key update expires=values(expires), reason=values(reason)"
+        self.cursor.executemany(s1, bad_contracts)
+
+    def get_bad_contracts(self, kind):
+        s1 = "select address, expires from t_bad_contracts where kind=%s"
+        self.cursor.execute(s1, (kind, ))
+        return self.fetch_with_description(self.cursor)
+
     def get_pairs_max_block(self, pair_id_start=None, pair_id_end=None):
         s1 = "select t_pairs2.pair_id pair_id, pair, token0, token1, token, swaps, "
         s1 += "first_block_number, max(t_event_history2.block_number) max_block_number from t_pairs2 "
@@ -549,6 +607,15 @@ class DBMySQL(object):
         i3 = self.cursor.execute(s3, (start_pair, end_pair))
         return i1, i2, i3
 
+    def add_eth_prices(self, rows):
+        s1 = "insert into t_eth_prices(timestamp, price) values(%s, %s) on duplicate key update price=values(price)"
+        self.cursor.executemany(s1, [(r["timestamp"], r["price"]) for r in rows])
+
+    def get_eth_prices(self):
+        s1 = "select timestamp, price from t_eth_prices order by timestamp"
+        self.cursor.execute(s1)
+        return self.fetch_with_description(self.cursor)
+
     def add_token(self, token, token_name, token_symbol, decimals):
         s0 = "select * from t_tokens2 where token=%s"
         l = self.cursor.execute(s0, (token, ))
@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+from collections import deque
+
+def revert_rate(rate):
+    if rate == 0:
+        return 1e100
+    return 1/rate
+
+class RateGraph:
+    # rates[(a, b)] is the number of b for 1 a, every pair is an edge both ways,
+    # connected components are kept in a union-find as pairs are added, prices are cached per base token until the next add
+    def __init__(self, rates):
+        self.edges = {}
+        self.parents = {}
+        self.cache = {}
+        for pair in rates:
+            self.add(pair, rates[pair])
+
+    def find(self, token):
+        root = token
+        while self.parents.get(root, root) != root:
+            root = self.parents[root]
+        while token != root:
+            self.parents[token], token = root, self.parents[token]
+        return root
+
+    def add(self, pair, rate):
+        a, b = pair
+        if not a in self.edges:
+            self.edges[a] = []
+        if not b in self.edges:
+            self.edges[b] = []
+        self.edges[a].append((b, rate))
+        self.edges[b].append((a, revert_rate(rate)))
+        root_a = self.find(a)
+        root_b = self.find(b)
+        if root_a != root_b:
+            self.parents[root_a] = root_b
+        self.cache = {}
+
+    def prices(self, base_token):
+        # number of each reachable token for 1 base token, along the path with the fewest hops,
+        # ties go to the pair seen first
+        prices = self.cache.get(base_token)
+        if prices is None:
+            prices = {base_token: 1}
+            queue = deque([base_token])
+            while len(queue):
+                token = queue.popleft()
+                for next_token, rate in self.edges.get(token, []):
+                    if not next_token in prices:
+                        prices[next_token] = prices[token] * rate
+                        queue.append(next_token)
+            self.cache[base_token] = prices
+        return dict(prices)
+
+    def connected(self, tokenA, tokenB):
+        return self.find(tokenA) == self.find(tokenB)
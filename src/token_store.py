@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import threading
+
+from node_rpc import get_tokens_decimals
+
+DEFAULT_DECIMALS = 18
+MAX_DECIMALS = 77
+
+def decimals_scale(decimals):
+    # no answer or a nonsense one keeps the 18 decimals default
+    if decimals is None or decimals > MAX_DECIMALS:
+        decimals = DEFAULT_DECIMALS
+    return 10.0 ** decimals
+
+class TokenStore:
+    # token -> 10 ** decimals, warm loaded from t_tokens2, tokens never seen are resolved on chain in one multicall
+    # per block, every answer is kept for good and new ones are written back on flush
+    def __init__(self, scales=None):
+        self.scales = dict(scales) if not scales is None else {}
+        self.new_tokens = {}
+        self.lock = threading.Lock()
+
+    def load(self, db):
+        for r in db.get_tokens():
+            if not r["token"] is None:
+                self.scales[r["token"].lower()] = decimals_scale(None if r["decimals"] is None else int(r["decimals"]))
+        print("tokens loaded", len(self.scales))
+
+    def resolve(self, w3, tokens):
+        tokens = set(t.lower() for t in tokens if t != "eth")
+        tokens = [t for t in tokens if not t in self.scales]
+        if len(tokens) == 0:
+            return 0
+        decimals = get_tokens_decimals(w3, tokens)
+        with self.lock:
+            for token in decimals:
+                d = decimals[token]
+                if not d is None and d > MAX_DECIMALS:
+                    d = None
+                self.scales[token] = decimals_scale(d)
+                self.new_tokens[token] = d
+        return len(tokens)
+
+    def flush(self, db):
+        with self.lock:
+            new_tokens, self.new_tokens = self.new_tokens, {}
+        for token in new_tokens:
+            # rows written by other tools keep their names
+            if len(db.get_token(token)) == 0:
+                db.add_token(token, "", "", new_tokens[token])
@@ -0,0 +1,26 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import random
+
+from attack_rules import OPERATORS, compare, compile_attack_classes, classify_bundles
+
+VALUES = [0, 1, 2, -1, 0.5, 2.5, 10**30, True, False, None, float("nan"), "0xabc", "0xdef", "1", ""]
+LIMITS = [0, 1, 2.5, True, None, "0xabc", "1", ""]
+
+def test_classify_bundles_matches_compare():
+    rng = random.Random(1)
+    bundles = [{"a": rng.choice(VALUES), "b": rng.choice(VALUES)} for _ in range(300)]
+    # every operator against every kind of limit, and a property no bundle has
+    attack_classes = [{"attackClassId": i, "rules": {"a": [op, limit]}}
+                      for i, (op, limit) in enumerate((op, limit) for op in OPERATORS for limit in LIMITS)]
+    attack_classes.append({"attackClassId": len(attack_classes), "rules": {"a": ["GE", 0], "b": ["NE", "0xabc"], "c": ["EQ", 0]}})
+    attack_classes = compile_attack_classes(attack_classes)
+    matches = classify_bundles(bundles, attack_classes)
+    for c in attack_classes:
+        expected = [c["predicate"](b) for b in bundles]
+        assert matches[c["attackClassId"]].tolist() == expected, c["rules"]
+    for op in OPERATORS:
+        for limit in LIMITS:
+            c = [c for c in attack_classes if c["rules"] == {"a": [op, limit]}][0]
+            assert matches[c["attackClassId"]].tolist() == [compare(op, b["a"], limit) for b in bundles]
@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import pytest
+from web3 import Web3
+
+from bloom import BLOOM_BYTES, bloom_bits, bloom_add, bloom_contains, bloom_contains_any, address_topic
+
+try:
+    import price_monitor
+except Exception:
+    # needs parameters.json, the key files and MySQLdb
+    price_monitor = None
+
+SWAP_V2 = "0xd78ad95fa46c994b6551d0da85fc275fe613ce37657fb8d5e3d130840159d822"
+TRANSFER = "0xddf252ad1be2c89b69c2b068fc378daa952ba7f163c4a11628f55a4df523b3ef"
+APPROVAL = "0x8c5be1e5ebec7d5bd14f71427d1e84f3dd0314c0f7b2291e5b0a4a62e33e6b92"
+WETH = "0xc02aaa39b223fe8d0a0e5c4f27ead9083c756cc2"
+USDC_WETH_V2 = "0xb4e16d0156e6a48d0e2b2a1c4b96c8b1b6efc0ba"
+ROUTER_V2 = "0x7a250d5630b4cf539739df2c5dacb4c659f2488d"
+SENDER = "0x3fc91a3afd70395cd496c647d5a6cc9d4b2b7fad"
+BOT = "0x00000000003b3cc22af3ae1eac0440bcee416b40"
+
+def make_bloom(logs):
+    bloom = bytearray(BLOOM_BYTES)
+    for address, topics in logs:
+        bloom_add(bloom, address)
+        for topic in topics:
+            bloom_add(bloom, topic)
+    return bytes(bloom)
+
+# a router swap on the USDC/WETH pair: the WETH transfer to the pair and the pair's Swap event
+SWAP_LOGS = [(WETH, [TRANSFER, address_topic(SENDER), address_topic(USDC_WETH_V2)]),
+             (USDC_WETH_V2, [SWAP_V2, address_topic(ROUTER_V2), address_topic(SENDER)])]
+
+def test_bloom_bits_known_vector():
+    # go-ethereum core/types/bloom9_test.go TestBloomExtensively
+    bloom = bytearray(BLOOM_BYTES)
+    for i in range(100):
+        bloom_add(bloom, ("xxxxxxxxxx data %d yyyyyyyyyyyyyy" % i).encode())
+    assert Web3.keccak(bytes(bloom)).hex() == "0xc8d3ca65cdb4874300a9e39475508f23ed6da09fdbc487f89a2dcf50b09eb263"
+
+def test_bloom_bits_positions():
+    bits = bloom_bits(TRANSFER)
+    assert len(bits) == 3 and all(0 <= b < 2048 for b in bits)
+    # the same value as a hex string or as bytes
+    assert bits == bloom_bits(bytes.fromhex(TRANSFER[2:]))
+    assert bits != bloom_bits(APPROVAL)
+
+def test_bloom_contains():
+    # go-ethereum core/types/bloom9_test.go TestBloom
+    bloom = bytearray(BLOOM_BYTES)
+    for value in ["testtest", "test", "hallo", "other"]:
+        bloom_add(bloom, value.encode())
+    for value in ["testtest", "test", "hallo", "other"]:
+        assert bloom_contains(bloom, value.encode())
+    for value in ["tes", "lo"]:
+        assert not bloom_contains(bloom, value.encode())
+
+def test_bloom_contains_any():
+    bloom = make_bloom(SWAP_LOGS)
+    assert bloom_contains_any(bloom, [bloom_bits(APPROVAL), bloom_bits(SWAP_V2)])
+    assert bloom_contains_any("0x" + bloom.hex(), [bloom_bits(address_topic(ROUTER_V2))])
+    assert not bloom_contains_any(bloom, [bloom_bits(APPROVAL), bloom_bits(address_topic(BOT))])
+    assert not bloom_contains_any(bytes(BLOOM_BYTES), [bloom_bits(t) for t in [TRANSFER, SWAP_V2]])
+
+@pytest.mark.skipif(price_monitor is None, reason="price_monitor configuration is not available")
+def test_prune_groups_by_bloom():
+    groups = {(SENDER, ROUTER_V2): [0, 2], (SENDER, BOT): [1, 3]}
+    block = {"logsBloom": make_bloom(SWAP_LOGS)}
+    # the router shows up as an indexed address, the bot contract in no log at all
+    assert price_monitor.prune_groups_by_bloom(groups, block) == {(SENDER, ROUTER_V2): [0, 2]}
+    # none of the processed topics in the block
+    block = {"logsBloom": make_bloom([(WETH, [APPROVAL, address_topic(SENDER), address_topic(ROUTER_V2)])])}
+    assert price_monitor.prune_groups_by_bloom(groups, block) == {}
+    # without a bloom nothing is pruned
+    assert price_monitor.prune_groups_by_bloom(groups, {}) == groups
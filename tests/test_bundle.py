@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import json
+import pytest
+
+from bundle import Bundle, TokenTable, bundles_to_dicts
+from caches import NegativeCache
+from token_store import TokenStore
+
+try:
+    import price_monitor
+except Exception:
+    # needs parameters.json, the key files and MySQLdb
+    price_monitor = None
+
+BLOCK = 19000000
+WETH = "0xc02aaa39b223fe8d0a0e5c4f27ead9083c756cc2"
+USDC = "0xa0b86991c6218b36c1d19d4a2e9eb0ce3606eb48"
+USDT = "0xdac17f958d2ee523a2206206994597c13d831ec7"
+V2_POOL = "0xB4e16d0156e6a48d0e2b2A1c4b96c8B1B6eFC0BA"
+V3_POOL = "0x88e6A0c2dDD26FEEb64F039a2c41296FcB3f5640"
+V2_USDT_POOL = "0x0d4a11d5EEaaC28EC3F61d100daF4d40471f1852"
+SWAP_V2 = "0xd78ad95fa46c994b6551d0da85fc275fe613ce37657fb8d5e3d130840159d822"
+SWAP_V3 = "0xc42079f94a6350d7e6235f29174924f928cc2ac818eb64fed8004e115fbcca67"
+DEPOSIT = "0xe1fffcc4923d04b559f4d29a8bfc6cda04eb5b0d3c460751c2402c5c5cc9109c"
+TRANSFER = "0xddf252ad1be2c89b69c2b068fc378daa952ba7f163c4a11628f55a4df523b3ef"
+EOA = "0x3fc91a3afd70395cd496c647d5a6cc9d4b2b7fad"
+BOT = "0x00000000003b3cc22af3ae1eac0440bcee416b40"
+BOT2 = "0x6b75d8af000000e20b7a7ddf000ba900b4009a80"
+
+def DECIMALS(token):
+    return {USDC: 1e6}.get(token, 1e18)
+
+def test_from_dict_roundtrip():
+    table = TokenTable(DECIMALS)
+    bundle = Bundle(transactions=[], a_innerTxNumber=1, directBribe=0, gasBurnt=0, gasOverpay=0, min_index=3, max_index=5)
+    bundle.start(table, [USDC, WETH, "eth"])
+    bundle.add_pair(USDC, WETH, -2500 * 10**6, 10**18)
+    bundle.add_pair(USDC, WETH, 2600 * 10**6, -10**18)
+    bundle["bundleId"] = 7
+    bundle["blockNumber"] = BLOCK
+    d = bundle.to_dict()
+    assert d["saldo"] == {USDC: 100.0, WETH: 0.0, "eth": 0.0}
+    assert d["capitalRequirements"] == {USDC: 2500.0, WETH: 0.0, "eth": 0}
+    again = Bundle.from_dict(d, TokenTable(DECIMALS))
+    assert again.to_dict() == d
+    assert again.bundleId == 7 and again["blockNumber"] == BLOCK
+    # token fields stored as null stay unset, excluded fields are not taken over
+    again = Bundle.from_dict(dict(d, saldo=None), exclude={"capitalRequirements", "min_index"})
+    assert not "saldo" in again and not "capitalRequirements" in again and not "min_index" in again
+
+def test_gas_summed_in_wei():
+    bundle = Bundle()
+    bundle.start(TokenTable(DECIMALS), ["eth"])
+    bundle.update_gas({"hash": "0x01", "gasBurnt": 10**17, "gasOverpay": 10**17, "directBribe": 10**17})
+    bundle.update_gas({"hash": "0x02", "gasBurnt": 2 * 10**17, "gasOverpay": 2 * 10**17, "directBribe": 2 * 10**17})
+    # the same transaction counts once
+    bundle.update_gas({"hash": "0x02", "gasBurnt": 2 * 10**17, "gasOverpay": 2 * 10**17, "directBribe": 2 * 10**17})
+    # 0.1 + 0.2 added as floats is not 0.3
+    assert bundle.gasBurnt == bundle.gasOverpay == bundle.directBribe == 0.3
+    assert bundle.saldo_values["eth"] == -9 * 10**17
+    assert bundle.balances() == ({"eth": -0.9}, {"eth": 0.9})
+
+def word(value):
+    return (value % (1 << 256)).to_bytes(32, "big").hex()
+
+def topic(address):
+    return "0x" + "00" * 12 + address[2:].lower()
+
+def event(tx_hash, address, topics, data_words):
+    return {"blockNumber": BLOCK, "transactionHash": tx_hash, "address": address, "topics": topics,
+            "data": "0x" + "".join(word(w) for w in data_words)}
+
+def transaction(tx_hash, index, from_tx, to_tx, direct_bribe=0):
+    return {"hash": tx_hash, "blockNumber": BLOCK, "transactionIndex": index, "fromTx": from_tx, "toTx": to_tx,
+            "gasUsed": 150000, "gasPrice": 30 * 10**9, "maxFeePerGas": 40 * 10**9, "maxPriorityFeePerGas": 10**9,
+            "gasBurnt": 150000 * 29 * 10**9, "gasOverpay": 150000 * 10**9, "directBribe": direct_bribe,
+            "value": 0, "role": 1}
+
+TX1 = "0x" + "11" * 32
+TX2 = "0x" + "22" * 32
+TX3 = "0x" + "33" * 32
+TRANSACTIONS = [transaction(TX1, 3, EOA, BOT), transaction(TX2, 5, EOA, BOT, 4 * 10**16),
+                transaction(TX3, 9, EOA, BOT2, 10**16)]
+EVENTS = [
+    # BOT: wraps eth, buys USDC on the v2 pool, sells it on the v3 pool
+    event(TX1, WETH, [DEPOSIT, topic(BOT)], [10**18]),
+    event(TX1, WETH, [TRANSFER, topic(BOT), topic(V2_POOL)], [10**18]),
+    event(TX1, V2_POOL, [SWAP_V2, topic(BOT), topic(BOT)], [0, 10**18, 2500 * 10**6, 0]),
+    event(TX2, V3_POOL, [SWAP_V3, topic(BOT), topic(BOT)], [2500 * 10**6, -(10**18 + 3 * 10**16), 0, 0, 0]),
+    # BOT2: USDT to WETH on its own, no stablecoin pair with WETH in the rates
+    event(TX3, V2_USDT_POOL, [SWAP_V2, topic(BOT2), topic(BOT2)], [0, 1000 * 10**6, 4 * 10**17, 0]),
+]
+POOLS = {V2_POOL: (USDC, WETH), V3_POOL: (USDC, WETH), V2_USDT_POOL: (WETH, USDT)}
+
+class FixedPrice:
+    def get_rate(self, timestamp=None):
+        return 2500.0
+
+def run_context():
+    return {"eth_prices": FixedPrice(), "pairs_VXXX": dict(POOLS), "bad_pools": NegativeCache("pool"), "w3": None,
+            "tokens": TokenStore({WETH: 1e18, USDC: 1e6, USDT: 1e6}), "stats": {}, "multisender_attackers": []}
+
+def persisted(bundles):
+    # what update_bundles writes and get_block_data reads back
+    rows = {}
+    for i, b in enumerate(bundles):
+        bundle = bundles[b]
+        row = {"bundleId": 100 + i, "blockNumber": b[0], "attacker0": b[1], "attacker1": b[2]}
+        for k in ["directBribe", "gasBurnt", "gasOverpay", "profitEstimation", "totalCapital", "bribesRatio"]:
+            row[k] = bundle[k]
+        row["saldo"] = json.loads(json.dumps(bundle["saldo"]))
+        row["capitalRequirements"] = json.loads(json.dumps(bundle["capitalRequirements"]))
+        row["rates"] = {(r[0], r[1]): r[2] for r in json.loads(json.dumps([[r[0], r[1], bundle["rates"][r]] for r in bundle["rates"]]))}
+        row["features"] = json.dumps({f: bundle[f] for f in bundle if f[:2] == "a_"})
+        row.update(json.loads(row["features"]))
+        rows[b] = row
+    return rows
+
+@pytest.mark.skipif(price_monitor is None, reason="price_monitor configuration is not available")
+def test_persisted_bundle_reprocessed():
+    from_to_hashes = {(EOA, BOT): {"tx_counter": 1, "min_index": 3, "max_index": 5},
+                      (EOA, BOT2): {"tx_counter": 0, "min_index": 9, "max_index": 9}}
+    bundles = price_monitor.make_block_bundles(BLOCK, TRANSACTIONS, from_to_hashes)
+    first = bundles_to_dicts(price_monitor.process_bundles(run_context(), EVENTS, TRANSACTIONS, bundles))
+    assert sorted(first) == [(BLOCK, EOA, BOT), (BLOCK, EOA, BOT2)]
+    # 1 eth wrapped and swapped round for 1.03 WETH
+    assert first[(BLOCK, EOA, BOT)]["saldo"][WETH] == pytest.approx(1.03)
+    assert first[(BLOCK, EOA, BOT)]["bribesRatio"] > 0
+
+    rows = persisted(first)
+    again = bundles_to_dicts(price_monitor.process_bundles(run_context(), EVENTS, TRANSACTIONS, rows))
+    assert sorted(again) == sorted(first)
+    for b in first:
+        assert again[b]["bundleId"] == rows[b]["bundleId"]
+        for k in first[b]:
+            if not k in ["transactions", "min_index", "max_index", "bundleId"]:
+                assert again[b][k] == first[b][k], k
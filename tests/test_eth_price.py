@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import pytest
+
+import eth_price
+from eth_price import DAY, EthPriceError, EthPriceService
+
+START = 1700000000 // DAY * DAY
+
+class DB:
+    def __init__(self, rows):
+        self.rows = {r["timestamp"]: r["price"] for r in rows}
+
+    def get_eth_prices(self):
+        return [{"timestamp": t, "price": self.rows[t]} for t in sorted(self.rows)]
+
+    def add_eth_prices(self, rows):
+        for r in rows:
+            self.rows[r["timestamp"]] = r["price"]
+
+    def commit(self):
+        pass
+
+def price(day):
+    return 2000.0 + (day - START) // DAY
+
+def daily_prices(available=True):
+    # the ethdailyprice endpoint, one point per day, or the answer of a key without the pro api
+    requests = []
+
+    def etherscan_get_ethusd(etherscan_key, startdate=None, enddate=None):
+        requests.append((int(startdate.timestamp()), int(enddate.timestamp())))
+        if not available:
+            return "Sorry, it looks like you are trying to access an API Pro endpoint"
+        return [{"unixTimeStamp": str(day), "value": str(price(day))}
+                for day in range(int(startdate.timestamp()), int(enddate.timestamp()) + DAY, DAY)]
+    return etherscan_get_ethusd, requests
+
+def stored(days):
+    return DB([{"timestamp": START + d * DAY, "price": price(START + d * DAY)} for d in days])
+
+def test_interior_gaps_filled(monkeypatch):
+    fetch, requests = daily_prices()
+    monkeypatch.setattr(eth_price, "etherscan_get_ethusd", fetch)
+    db = stored([2, 3, 6, 9])
+    service = EthPriceService("key")
+    assert service.preload(db, START, START + 10 * DAY) == []
+    # before, between and after the stored days, each gap in one request
+    assert requests == [(START, START + DAY), (START + 4 * DAY, START + 5 * DAY), (START + 7 * DAY, START + 8 * DAY),
+                        (START + 10 * DAY, START + 10 * DAY)]
+    assert sorted(db.rows) == [START + d * DAY for d in range(11)]
+    assert service.get_rate(START + 4 * DAY + 100) == price(START + 4 * DAY)
+
+def test_unavailable_endpoint_uses_stored_history(monkeypatch):
+    fetch, requests = daily_prices(available=False)
+    monkeypatch.setattr(eth_price, "etherscan_get_ethusd", fetch)
+    service = EthPriceService("key")
+    service.live_price = 9999.0
+    unavailable = service.preload(stored([2, 3, 6]), START + 2 * DAY, START + 10 * DAY, historical=True)
+    assert [(first_day, last_day) for first_day, last_day, result in unavailable] == \
+        [(START + 4 * DAY, START + 5 * DAY), (START + 7 * DAY, START + 10 * DAY)]
+    # the gaps take the nearest earlier stored day, in a historical run past the last one too
+    assert service.get_rate(START + 5 * DAY) == price(START + 3 * DAY)
+    assert service.get_rate(START + 9 * DAY) == price(START + 6 * DAY)
+    # the newest blocks still take the live price
+    assert service.get_rate() == 9999.0
+
+def test_historical_without_any_price_refused(monkeypatch):
+    fetch, requests = daily_prices(available=False)
+    monkeypatch.setattr(eth_price, "etherscan_get_ethusd", fetch)
+    with pytest.raises(EthPriceError):
+        EthPriceService("key").preload(stored([]), START, START + 3 * DAY, historical=True)
+    assert EthPriceService("key").preload(stored([]), START, START + 3 * DAY) != []
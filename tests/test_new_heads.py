@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import asyncio
+import http
+import json
+import websockets
+
+import new_heads
+
+def head(number):
+    return {"jsonrpc": "2.0", "method": "eth_subscription",
+            "params": {"subscription": "0xsub", "result": {"number": hex(number)}}}
+
+async def serve_nodes(connections, heads, wanted):
+    # connections: one entry per client connection, "reject" refuses the handshake with a 503,
+    # a list of head numbers, or raw messages, is sent after the subscription reply and the socket is closed
+    attempts = []
+
+    async def process_request(path, request_headers):
+        attempts.append(path)
+        if connections[len(attempts) - 1] == "reject":
+            return http.HTTPStatus.SERVICE_UNAVAILABLE, [], b"node restarting\n"
+        return None
+
+    async def handler(ws, path=None):
+        request = json.loads(await ws.recv())
+        assert request["method"] == "eth_subscribe" and request["params"] == ["newHeads"]
+        await ws.send(json.dumps({"jsonrpc": "2.0", "id": request["id"], "result": "0xsub"}))
+        for number in connections[len(attempts) - 1]:
+            await ws.send(number if isinstance(number, str) else json.dumps(head(number)))
+        await ws.close()
+
+    async def on_head(header):
+        heads.append(int(header["number"], 16))
+
+    async with websockets.serve(handler, "127.0.0.1", 0, process_request=process_request) as server:
+        port = server.sockets[0].getsockname()[1]
+        subscriber = asyncio.create_task(new_heads.subscribe_new_heads("ws://127.0.0.1:%d" % port, on_head))
+        try:
+            while len(heads) < wanted:
+                if subscriber.done():
+                    subscriber.result()
+                await asyncio.sleep(0.01)
+        finally:
+            subscriber.cancel()
+    return attempts
+
+def run(connections, wanted, monkeypatch):
+    monkeypatch.setattr(new_heads, "RESUBSCRIBE_DELAY", 0.01)
+    monkeypatch.setattr(new_heads, "MAX_RESUBSCRIBE_DELAY", 0.02)
+    heads = []
+    attempts = asyncio.run(asyncio.wait_for(serve_nodes(connections, heads, wanted), 10))
+    return heads, attempts
+
+def test_resubscribes_after_disconnect(monkeypatch):
+    heads, attempts = run([[100, 101], [102]], 3, monkeypatch)
+    assert heads == [100, 101, 102]
+    assert len(attempts) == 2
+
+def test_survives_refused_handshake(monkeypatch):
+    heads, attempts = run(["reject", "reject", [100], [101]], 2, monkeypatch)
+    assert heads == [100, 101]
+    assert len(attempts) == 4
+
+def test_skips_malformed_notifications(monkeypatch):
+    malformed = ["{not json",
+                 json.dumps({"jsonrpc": "2.0", "method": "eth_subscription", "params": {"subscription": "0xsub"}}),
+                 json.dumps({"jsonrpc": "2.0", "method": "eth_subscription", "params": {"subscription": "0xsub", "result": {}}}),
+                 json.dumps({"jsonrpc": "2.0", "method": "eth_subscription", "params": None}),
+                 json.dumps([1, 2])]
+    heads, attempts = run([[100] + malformed + [101]], 2, monkeypatch)
+    assert heads == [100, 101]
+    assert len(attempts) == 1
@@ -0,0 +1,49 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import pytest
+
+import node_rpc
+from node_rpc import RPCError, get_blocks_batch
+
+MINER = "0x95222290DD7278Aa3Ddd389Cc1E1d165CC4BAfe5"
+
+def raw_block(number):
+    return {"number": hex(number), "hash": "0x" + "%064x" % number, "miner": MINER.lower(), "baseFeePerGas": "0x1",
+            "timestamp": hex(1700000000 + 12 * number), "logsBloom": "0x" + "00" * 256, "transactions": []}
+
+class Provider:
+    # single eth_getBlockByNumber requests, blocks in missing are not found
+    def __init__(self, missing=()):
+        self.missing = set(missing)
+        self.requests = []
+
+    def make_request(self, method, params):
+        number = int(params[0], 16)
+        self.requests.append(number)
+        return {"jsonrpc": "2.0", "id": 1, "result": None if number in self.missing else raw_block(number)}
+
+class W3:
+    def __init__(self, missing=()):
+        self.provider = Provider(missing)
+
+def failed_batch(failed):
+    # the batch answers every block but those in failed, as a rate limited provider does per item
+    def rpc_batch(w3, calls):
+        return [None if int(c[1][0], 16) in failed else raw_block(int(c[1][0], 16)) for c in calls]
+    return rpc_batch
+
+def test_failed_batch_items_refetched(monkeypatch):
+    monkeypatch.setattr(node_rpc, "rpc_batch", failed_batch({11, 13}))
+    w3 = W3()
+    stats = {}
+    blocks = get_blocks_batch(w3, range(10, 15), stats=stats)
+    assert sorted(blocks) == [10, 11, 12, 13, 14]
+    assert blocks[13]["number"] == 13
+    assert w3.provider.requests == [11, 13]
+    assert stats["blocks_refetched"] == 2
+
+def test_missing_block_raises(monkeypatch):
+    monkeypatch.setattr(node_rpc, "rpc_batch", failed_batch({12}))
+    with pytest.raises(RPCError):
+        get_blocks_batch(W3(missing={12}), range(10, 15))
@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import json
+import os
+import pytest
+
+from node_rpc import debug_trace_block_transfers, trace_block_transfers
+
+try:
+    import price_monitor
+except Exception:
+    # needs parameters.json, the key files and MySQLdb
+    price_monitor = None
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+BLOCK = 19000000
+MINER = "0x95222290DD7278Aa3Ddd389Cc1E1d165CC4BAfe5"
+TX_BUNDLE = "0x" + "a1" * 32
+TX_TRANSFER = "0x" + "b2" * 32
+TX_REVERTED = "0x" + "c3" * 32
+BRIBE = 5 * 10**16
+
+def load(name):
+    with open(os.path.join(FIXTURES, name)) as f:
+        return json.load(f)
+
+class Provider:
+    # answers json-rpc methods from the fixtures, anything else the way a node without the method does
+    def __init__(self, answers):
+        self.answers = answers
+        self.requests = []
+
+    def make_request(self, method, params):
+        self.requests.append(method)
+        if method in self.answers:
+            return {"jsonrpc": "2.0", "id": 1, "result": self.answers[method]}
+        return {"jsonrpc": "2.0", "id": 1, "error": {"code": -32601, "message": "the method " + method + " does not exist/is not available"}}
+
+class W3:
+    def __init__(self, answers):
+        self.provider = Provider(answers)
+
+TRACERS = [(debug_trace_block_transfers, "debug_traceBlockByNumber", "debug_traceBlockByNumber_callTracer.json"),
+           (trace_block_transfers, "trace_block", "trace_block.json")]
+
+@pytest.mark.parametrize("tracer, method, fixture", TRACERS)
+def test_transfers(tracer, method, fixture):
+    transfers = tracer(W3({method: load(fixture)}), BLOCK)
+    # the bribe and the WETH withdrawal, not the reverted subcall that would have paid the builder 1 ETH
+    assert sorted(transfers[TX_BUNDLE]) == sorted([(MINER.lower(), BRIBE), ("0x00000000003b3cc22af3ae1eac0440bcee416b40", 3 * 10**17)])
+    # the top level value of a transaction is not an internal transfer, as in etherscan's txlistinternal
+    assert transfers[TX_TRANSFER] == []
+    # nothing below a reverted transaction
+    assert transfers[TX_REVERTED] == []
+
+def test_call_tracer_without_tx_hash():
+    traces = [{"result": t["result"]} for t in load("debug_traceBlockByNumber_callTracer.json")]
+    transfers = debug_trace_block_transfers(W3({"debug_traceBlockByNumber": traces}), BLOCK,
+                                            [TX_BUNDLE, TX_TRANSFER, TX_REVERTED])
+    assert (MINER.lower(), BRIBE) in transfers[TX_BUNDLE]
+
+@pytest.mark.skipif(price_monitor is None, reason="price_monitor configuration is not available")
+@pytest.mark.parametrize("tracer, method, fixture", TRACERS)
+def test_direct_bribes_traced(tracer, method, fixture, monkeypatch):
+    bribe_source = "debug_trace" if method == "debug_traceBlockByNumber" else method
+    monkeypatch.setitem(price_monitor.parameters, "BRIBE_SOURCE", bribe_source)
+    run_context = {"w3": W3({method: load(fixture)}), "stats": {}}
+    assert price_monitor.get_direct_bribes(run_context, BLOCK, MINER) == {TX_BUNDLE: BRIBE}
+
+@pytest.mark.skipif(price_monitor is None, reason="price_monitor configuration is not available")
+@pytest.mark.parametrize("bribe_source", ["debug_trace", "trace_block"])
+def test_fallback_to_etherscan(bribe_source, monkeypatch):
+    monkeypatch.setitem(price_monitor.parameters, "BRIBE_SOURCE", bribe_source)
+    etherscan_calls = []
+
+    def get_direct_bribes_etherscan(run_context, block_number, miner):
+        etherscan_calls.append(block_number)
+        return {TX_BUNDLE: BRIBE}
+    monkeypatch.setattr(price_monitor, "get_direct_bribes_etherscan", get_direct_bribes_etherscan)
+    run_context = {"w3": W3({}), "stats": {}}
+    assert price_monitor.get_direct_bribes(run_context, BLOCK, MINER) == {TX_BUNDLE: BRIBE}
+    assert price_monitor.get_direct_bribes(run_context, BLOCK + 1, MINER) == {TX_BUNDLE: BRIBE}
+    # the missing trace method is asked for once
+    assert len(run_context["w3"].provider.requests) == 1
+    assert etherscan_calls == [BLOCK, BLOCK + 1]
+    assert run_context["stats"]["bribe_trace_errors"] == 1
+
+@pytest.mark.skipif(price_monitor is None, reason="price_monitor configuration is not available")
+@pytest.mark.parametrize("head_block_number, cached", [(BLOCK + 10**6, True), (BLOCK + 50, False)])
+def test_etherscan_window_cached_below_head(head_block_number, cached, monkeypatch):
+    monkeypatch.setitem(price_monitor.parameters, "BRIBE_BLOCK_WINDOW", 300)
+    monkeypatch.setitem(price_monitor.parameters, "REORG_DEPTH", 64)
+    requests = []
+
+    def etherscan_get_internals(etherscan_key, block_number, address=None, end_block=None, cache=False):
+        requests.append((block_number, end_block, cache))
+        return [{"blockNumber": str(BLOCK), "hash": TX_BUNDLE, "to": MINER.lower(), "value": str(BRIBE)}]
+    monkeypatch.setattr(price_monitor, "etherscan_get_internals", etherscan_get_internals)
+    # the window reaches the end of the backfill shard, which is deep history when the head is far ahead
+    run_context = {"etherscan_key": "", "bribes_cache": {}, "stats": {}, "last_block_number": BLOCK + 20,
+                   "head_block_number": head_block_number}
+    assert price_monitor.get_direct_bribes_etherscan(run_context, BLOCK, MINER) == {TX_BUNDLE: BRIBE}
+    assert requests == [(BLOCK, BLOCK + 20, cached)]